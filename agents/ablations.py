@@ -1,85 +1,113 @@
-import json
 from agents.mdoc_agent import MDocAgent
 
 class MDAi(MDocAgent):
+    supports_early_exit = False
+
     def __init__(self, config):
         super().__init__(config)
     
-    def predict(self, sample, question, texts, images):
+    def predict(self, question, texts, images):
         general_agent = self.agents[-1]
         general_response, messages = general_agent.predict(question, texts, images, with_sys_prompt=True)
-        critical_info = general_agent.self_reflect(prompt = general_agent.config.agent.critical_prompt, add_to_message=False)
-
-        start_index = critical_info.find('{') 
-        end_index = critical_info.find('}') + 1 
-        critical_info = critical_info[start_index:end_index]
-        text_info = ""
-        image_info = ""
-        try:
-            critical_info = json.loads(critical_info)
-            text_info = critical_info.get("text", "")
-            image_info = critical_info.get("image", "")
-        except Exception as e:
-            print(e)
+        text_info, image_info = self.critical_info(general_agent)
 
         image_agent = self.agents[0]
         all_messages = "General Agent:\n" + general_response + "\n"
         
         relect_prompt = "\nYou may use the given clue:\n"
 
-        image_response, messages = image_agent.predict(question + relect_prompt + image_info, texts = None, images = images, with_sys_prompt=True)
+        (image_response, messages), = self.run_agents([
+            (image_agent, question + relect_prompt + image_info, None, images),
+        ])
         all_messages += "Image Agent:\n" + image_response + "\n"
             
         final_ans, final_messages = self.sum(all_messages)
         
         return final_ans, final_messages
+
+    def predict_batch(self, inputs):
+        questions = [question for question, _, _ in inputs]
+        images_list = [images for _, _, images in inputs]
+        general_responses, reflections = self.general_stage_batch(questions, [texts for _, texts, _ in inputs], images_list)
+
+        relect_prompt = "\nYou may use the given clue:\n"
+        image_responses, _ = self.agents[0].predict_batch(
+            [question + relect_prompt + image_info for question, (_, image_info) in zip(questions, reflections)],
+            images_list=images_list,
+        )
+        return self.sum_batch([
+            "General Agent:\n" + general_response + "\n" + "Image Agent:\n" + image_response + "\n"
+            for general_response, image_response in zip(general_responses, image_responses)
+        ])
     
 class MDAt(MDocAgent):
+    supports_early_exit = False
+
     def __init__(self, config):
         super().__init__(config)
     
-    def predict(self, sample, question, texts, images):
+    def predict(self, question, texts, images):
         general_agent = self.agents[-1]
         outputs, messages = general_agent.predict(question, texts, images, with_sys_prompt=True)
-        critical_info = general_agent.self_reflect(prompt = general_agent.config.agent.critical_prompt, add_to_message=False)
-
-        start_index = critical_info.find('{') 
-        end_index = critical_info.find('}') + 1 
-        critical_info = critical_info[start_index:end_index]
-        text_info = ""
-        image_info = ""
-        try:
-            critical_info = json.loads(critical_info)
-            text_info = critical_info.get("text", "")
-            image_info = critical_info.get("image", "")
-        except Exception as e:
-            print(e)
+        text_info, image_info = self.critical_info(general_agent)
 
         text_agent = self.agents[1]
         all_messages = "General Agent:\n" + outputs + "\n"
         
         relect_prompt = "\nYou may use the given clue:\n"
-        text_response, messages = text_agent.predict(question + relect_prompt + text_info, texts = texts, images = None, with_sys_prompt=True)
+        (text_response, messages), = self.run_agents([
+            (text_agent, question + relect_prompt + text_info, texts, None),
+        ])
         all_messages += "Text Agent:\n" + text_response + "\n"
 
         final_ans, final_messages = self.sum(all_messages)
         
         return final_ans, final_messages
+
+    def predict_batch(self, inputs):
+        questions = [question for question, _, _ in inputs]
+        texts_list = [texts for _, texts, _ in inputs]
+        general_responses, reflections = self.general_stage_batch(questions, texts_list, [images for _, _, images in inputs])
+
+        relect_prompt = "\nYou may use the given clue:\n"
+        text_responses, _ = self.agents[1].predict_batch(
+            [question + relect_prompt + text_info for question, (text_info, _) in zip(questions, reflections)],
+            texts_list=texts_list,
+        )
+        return self.sum_batch([
+            "General Agent:\n" + general_response + "\n" + "Text Agent:\n" + text_response + "\n"
+            for general_response, text_response in zip(general_responses, text_responses)
+        ])
     
 class MDAs(MDocAgent):
+    supports_early_exit = False
+
     def __init__(self, config):
         super().__init__(config)
     
-    def predict(self, sample, question, texts, images):
+    def predict(self, question, texts, images):
         text_agent = self.agents[1]
         image_agent = self.agents[0]
         all_messages = ""
         
-        text_response, messages = text_agent.predict(question, texts = texts, images = None, with_sys_prompt=True)
+        (text_response, _), (image_response, _) = self.run_agents([
+            (text_agent, question, texts, None),
+            (image_agent, question, None, images),
+        ])
         all_messages += "Text Agent:\n" + text_response + "\n"
-        image_response, messages = image_agent.predict(question, texts = None, images = images, with_sys_prompt=True)
         all_messages += "Image Agent:\n" + image_response + "\n"
             
         final_ans, final_messages = self.sum(all_messages)
         
-        return final_ans, final_messages
\ No newline at end of file
+        return final_ans, final_messages
+
+    def predict_batch(self, inputs):
+        questions = [question for question, _, _ in inputs]
+        (text_responses, _), (image_responses, _) = self.run_agents_batch([
+            (self.agents[1], questions, [texts for _, texts, _ in inputs], None),
+            (self.agents[0], questions, None, [images for _, _, images in inputs]),
+        ])
+        return self.sum_batch([
+            "Text Agent:\n" + text_response + "\n" + "Image Agent:\n" + image_response + "\n"
+            for text_response, image_response in zip(text_responses, image_responses)
+        ])
\ No newline at end of file
@@ -1,4 +1,8 @@
 from models.base_model import BaseModel
+from models.image_budget import ImageBudget
+from models.registry import registry
+from models.response_cache import ResponseCache
+from agents.early_exit import summarize_early_exit
 from mydatasets.base_dataset import BaseDataset
 import os
 from typing import Dict, Union
@@ -7,19 +11,34 @@ import pandas as pd
 from tqdm import tqdm
 import re
 import importlib
+import asyncio
 
 class Agent:
     def __init__(self, config, model=None):
         self.config = config
         self.messages = None
+        self.owns_model = model is None
         if model is not None:
             self.model:BaseModel = model
         else:
-            module = importlib.import_module(self.config.model.module_name)
-            model_class = getattr(module, self.config.model.class_name)
-            print("Create model: ", self.config.model.class_name)
-            self.model = model_class(self.config.model)
+            # Shared with any other user of the same model_id, loaded on first predict
+            self.model = registry.acquire(self.config.model)
+        # Generation settings and pixel limits in this agent's model config apply to its calls
+        # even when the model instance is shared
+        self.image_budget = ImageBudget.from_config(self.config.model)
+        self.model_kwargs = {
+            "max_new_tokens": getattr(self.config.model, "max_new_tokens", None),
+            "temperature": getattr(self.config.model, "temperature", None),
+        }
+        if self.image_budget is not None:
+            self.model_kwargs["image_budget"] = self.image_budget
+        self.response_cache = ResponseCache.from_config(self.config.model)
     
+    def close(self):
+        if self.owns_model:
+            registry.release(self.model)
+            self.owns_model = False
+
     def clean_messages(self):
         self.messages = None
         
@@ -28,16 +47,90 @@ class Agent:
             texts = None
         if not self.config.agent.use_image:
             images = None
-        generated_ans, messages = self.model.predict(question, texts, images, self.messages)
+        generated_ans, messages = self.model_predict(question, texts, images, self.messages)
         if add_to_message:
             self.messages = messages
         return generated_ans, messages
     
+    def model_predict(self, question, texts=None, images=None, history=None):
+        """model.predict behind the response cache, if one is configured."""
+        if self.response_cache is None:
+            return self.model.predict(question, texts, images, history, **self.model_kwargs)
+        # The key is taken before predict, which appends to history
+        key = self.response_cache.key(question, texts, images, history, self.model_kwargs)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return cached
+        generated_ans, messages = self.model.predict(question, texts, images, history, **self.model_kwargs)
+        self.response_cache.put(key, generated_ans, messages)
+        return generated_ans, messages
+
+    async def amodel_predict(self, question, texts=None, images=None, history=None):
+        """model.apredict behind the response cache, like model_predict."""
+        if self.response_cache is None:
+            return await self.model.apredict(question, texts, images, history, **self.model_kwargs)
+        key = self.response_cache.key(question, texts, images, history, self.model_kwargs)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return cached
+        generated_ans, messages = await self.model.apredict(question, texts, images, history, **self.model_kwargs)
+        self.response_cache.put(key, generated_ans, messages)
+        return generated_ans, messages
+
+    def model_predict_batch(self, questions, texts_list, images_list, histories):
+        if self.response_cache is None:
+            return self.model.predict_batch(questions, texts_list, images_list, histories, **self.model_kwargs)
+        histories = histories or [None] * len(questions)
+        keys = [
+            self.response_cache.key(question, texts, images, history, self.model_kwargs)
+            for question, texts, images, history in zip(questions, texts_list, images_list, histories)
+        ]
+        results = [self.response_cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            answers, messages_list = self.model.predict_batch(
+                [questions[i] for i in missing], [texts_list[i] for i in missing],
+                [images_list[i] for i in missing], [histories[i] for i in missing], **self.model_kwargs
+            )
+            for i, answer, messages in zip(missing, answers, messages_list):
+                self.response_cache.put(keys[i], answer, messages)
+                results[i] = (answer, messages)
+        return [answer for answer, _ in results], [messages for _, messages in results]
+
+    def system_message(self):
+        # With system_prompt_first every conversation of this agent starts with the same system
+        # message, which local models prefill once and reuse
+        message = self.model.create_system_message(self.config.agent.system_prompt)
+        self.model.cache_prefix([message])
+        return message
+
     def predict(self, question, texts=None, images=None, with_sys_prompt=True):
         if with_sys_prompt:
-            question = self.config.agent.system_prompt + question
+            if getattr(self.config.agent, "system_prompt_first", False) and self.messages is None:
+                self.messages = [self.system_message()]
+            else:
+                question = self.config.agent.system_prompt + question
         return self._predict(question, texts, images, add_to_message = True)
     
+    def predict_batch(self, questions, texts_list=None, images_list=None, histories=None, with_sys_prompt=True):
+        """Batched counterpart of predict; histories are passed in and returned instead of kept on the agent."""
+        n = len(questions)
+        texts_list = texts_list if texts_list is not None and self.config.agent.use_text else [None] * n
+        images_list = images_list if images_list is not None and self.config.agent.use_image else [None] * n
+        if histories is not None:
+            # process_message appends to the history it is given, keep the caller's lists intact
+            histories = [list(history) if history is not None else None for history in histories]
+        if with_sys_prompt:
+            if getattr(self.config.agent, "system_prompt_first", False) and histories is None:
+                histories = [[self.system_message()] for _ in questions]
+            else:
+                questions = [self.config.agent.system_prompt + question for question in questions]
+        return self.model_predict_batch(questions, texts_list, images_list, histories)
+
+    def self_reflect_batch(self, histories, prompt=None):
+        self_reflect_prompt = self.config.agent.self_reflect_prompt if prompt is None else prompt
+        return self.predict_batch([self_reflect_prompt] * len(histories), histories=histories, with_sys_prompt=False)
+
     def self_reflect(self, prompt=None, add_to_message = True):
         if prompt is None:
             self_reflect_prompt = self.config.agent.self_reflect_prompt
@@ -53,39 +146,92 @@ class Agent:
     def eval(self, question, answer, gt):
         prompt = self.config.agent.eval_system_prompt.format(question=question, answer=answer, gt=gt)
         try:
-            generated_ans, _ = self.model.predict(prompt)
+            generated_ans, _ = self.model_predict(prompt)
             result = extract_evaluation_metrics(generated_ans)
             return result
         except Exception as e:
             print(f"Error evaluating answer: {str(e)}")
             return {"binary_correctness": 0}
     
-    def eval_dataset(self, dataset: BaseDataset):
-        samples, ans_path = dataset.load_latest_results()
-        if self.config.truncate_len:
-            samples = samples[:self.config.truncate_len]
-        samples_with_answer = []
-        for sample in tqdm(samples):
+    async def aeval(self, question, answer, gt):
+        prompt = self.config.agent.eval_system_prompt.format(question=question, answer=answer, gt=gt)
+        try:
+            generated_ans, _ = await self.amodel_predict(prompt)
+            result = extract_evaluation_metrics(generated_ans)
+            return result
+        except Exception as e:
+            print(f"Error evaluating answer: {str(e)}")
+            return {"binary_correctness": 0}
+
+    async def _aeval_samples(self, samples, dataset: BaseDataset):
+        pbar = tqdm(total=len(samples))
+        async def eval_sample(sample):
             try:
                 question = sample[dataset.config.question_key]
                 answer = sample[self.config.ans_key]
                 gt = sample[dataset.config.gt_key]
-                result = self.eval(question, answer, gt)
+                result = await self.aeval(question, answer, gt)
                 sample['binary_correctness'] = result.get('binary_correctness', None)
-                samples_with_answer.append(sample)
+                exit_info = self.shadow_exit_info(sample)
+                if exit_info is not None:
+                    result = await self.aeval(question, exit_info["general_answer"], gt)
+                    exit_info["general_correctness"] = result.get('binary_correctness', 0)
+                return sample
             except Exception as e:
                 print(f"Error evaluating sample: {str(e)}")
+                return None
+            finally:
+                pbar.update(1)
+        # gather keeps the input order, so results line up with the samples
+        results = await asyncio.gather(*[eval_sample(sample) for sample in samples])
+        pbar.close()
+        await self.model.aclose()
+        return [sample for sample in results if sample is not None]
+
+    def shadow_exit_info(self, sample):
+        """Early-exit record of a shadow run that would have exited; its general answer is evaluated too."""
+        exit_info = sample.get(self.config.ans_key + "_early_exit")
+        if isinstance(exit_info, dict) and exit_info.get("exit") and exit_info.get("shadow"):
+            return exit_info
+        return None
+
+    def eval_dataset(self, dataset: BaseDataset):
+        samples, ans_path = dataset.load_latest_results()
+        if self.config.truncate_len:
+            samples = samples[:self.config.truncate_len]
+        if hasattr(self.model, "apredict"):
+            # Async backends evaluate many samples concurrently
+            samples_with_answer = asyncio.run(self._aeval_samples(samples, dataset))
+        else:
+            samples_with_answer = []
+            for sample in tqdm(samples):
+                try:
+                    question = sample[dataset.config.question_key]
+                    answer = sample[self.config.ans_key]
+                    gt = sample[dataset.config.gt_key]
+                    result = self.eval(question, answer, gt)
+                    sample['binary_correctness'] = result.get('binary_correctness', None)
+                    exit_info = self.shadow_exit_info(sample)
+                    if exit_info is not None:
+                        result = self.eval(question, exit_info["general_answer"], gt)
+                        exit_info["general_correctness"] = result.get('binary_correctness', 0)
+                    samples_with_answer.append(sample)
+                except Exception as e:
+                    print(f"Error evaluating sample: {str(e)}")
                 
         ans_file_path_name = ans_path[:-5]+"_results.json"
         with open(ans_file_path_name, "w") as file:
             json.dump(samples_with_answer, file, indent=4)
             
+        early_exit_lines = summarize_early_exit(samples_with_answer, self.config.ans_key + "_early_exit")
         samples_with_answer = pd.DataFrame(samples_with_answer)
         path = os.path.join(dataset.config.result_dir,"results.txt")
         with open(path, "a") as file:
             file.write("\nEvaluation Results Summary:\n")
             file.write(f"Result file: {ans_path}\n")
             file.write(f"Average Binary Correctness: {samples_with_answer['binary_correctness'].mean():.3f}\n")
+            for line in early_exit_lines:
+                file.write(line + "\n")
         
         print(f"Save results to {path}.")
 
@@ -0,0 +1,107 @@
+import re
+import string
+from collections import Counter
+
+UNCERTAIN_PHRASES = [
+    "not provided", "not mentioned", "no information", "cannot be determined", "can't be determined",
+    "unable to", "not possible to", "does not contain", "doesn't contain", "not enough information",
+]
+
+
+def normalize_answer(answer):
+    answer = answer.lower()
+    answer = "".join(ch for ch in answer if ch not in string.punctuation)
+    answer = re.sub(r"\b(a|an|the)\b", " ", answer)
+    return answer.split()
+
+
+def answer_f1(answer, other):
+    """Token F1 between two free-form answers."""
+    tokens, other_tokens = normalize_answer(answer), normalize_answer(other)
+    common = sum((Counter(tokens) & Counter(other_tokens)).values())
+    if common == 0:
+        return 0.0
+    precision = common / len(tokens)
+    recall = common / len(other_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def score_margin(scores):
+    """Relative gap between the two best retrieval scores, or None with fewer than two pages."""
+    if scores is None or len(scores) < 2 or scores[0] == 0:
+        return None
+    return (scores[0] - scores[1]) / abs(scores[0])
+
+
+class EarlyExitPolicy():
+    """Decides whether the general agent's answer is final, so the reflection, specialist and sum calls can be skipped.
+
+    margin: exit when the top retrieved page clearly beats the runner-up (``*_score`` lists from retrieval).
+    agreement: exit when one fast specialist agent gives the same answer (token F1).
+    In both modes an answer that says the information is missing never exits. With shadow the
+    decision is only recorded and the full pipeline still runs, so the accuracy cost of exiting
+    can be measured before turning it on.
+    """
+    def __init__(self, mode, margin_threshold=0.1, agreement_threshold=0.6, specialist="text", shadow=False):
+        assert mode in ("margin", "agreement"), f"Unknown early exit mode: {mode}"
+        self.mode = mode
+        self.margin_threshold = margin_threshold
+        self.agreement_threshold = agreement_threshold
+        self.specialist = specialist
+        self.shadow = shadow
+        self.decisions = 0
+        self.exits = 0
+
+    @classmethod
+    def from_config(cls, config):
+        if config is None or not getattr(config, "mode", None):
+            return None
+        return cls(
+            mode=config.mode,
+            margin_threshold=getattr(config, "margin_threshold", 0.1),
+            agreement_threshold=getattr(config, "agreement_threshold", 0.6),
+            specialist=getattr(config, "specialist", "text"),
+            shadow=getattr(config, "shadow", False),
+        )
+
+    def is_uncertain(self, answer):
+        answer = answer.lower()
+        return any(phrase in answer for phrase in UNCERTAIN_PHRASES)
+
+    def decide(self, general_answer, scores=None, specialist_answer=None):
+        """:param scores: {"text": [...], "image": [...]} top-k retrieval scores of the sample."""
+        if self.mode == "margin":
+            margins = [score_margin(page_scores) for page_scores in (scores or {}).values()]
+            margins = [margin for margin in margins if margin is not None]
+            signal = max(margins) if margins else None
+            threshold = self.margin_threshold
+        else:
+            signal = answer_f1(general_answer, specialist_answer) if specialist_answer is not None else None
+            threshold = self.agreement_threshold
+        exit = signal is not None and signal >= threshold and not self.is_uncertain(general_answer)
+        self.decisions += 1
+        self.exits += int(exit)
+        return {"exit": exit, "skipped": exit and not self.shadow, "signal": signal, "shadow": self.shadow}
+
+
+def summarize_early_exit(samples, exit_key, correctness_key="binary_correctness"):
+    """Skip rate and accuracy effect of early exit over evaluated samples, as report lines."""
+    decided = [sample for sample in samples if isinstance(sample.get(exit_key), dict)]
+    if not decided:
+        return []
+    exited = [sample for sample in decided if sample[exit_key]["exit"]]
+    lines = [f"Early exit rate: {len(exited) / len(decided):.3f} ({len(exited)}/{len(decided)})"]
+    # Shadow runs evaluated both answers of the samples that would have exited
+    shadow = [sample for sample in exited if "general_correctness" in sample[exit_key]]
+    if shadow:
+        full = sum(sample.get(correctness_key) or 0 for sample in shadow) / len(shadow)
+        general = sum(sample[exit_key]["general_correctness"] for sample in shadow) / len(shadow)
+        total_delta = (general - full) * len(shadow) / len(decided)
+        lines.append(f"Early exit accuracy on exited samples: {general:.3f} (full pipeline {full:.3f})")
+        lines.append(f"Early exit accuracy delta over all samples: {total_delta:+.3f}")
+    elif exited:
+        kept = [sample for sample in decided if not sample[exit_key]["exit"]]
+        exited_acc = sum(sample.get(correctness_key) or 0 for sample in exited) / len(exited)
+        kept_acc = sum(sample.get(correctness_key) or 0 for sample in kept) / len(kept) if kept else 0.0
+        lines.append(f"Accuracy of exited samples: {exited_acc:.3f}, of full-pipeline samples: {kept_acc:.3f}")
+    return lines
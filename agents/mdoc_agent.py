@@ -6,44 +6,159 @@ import torch
 import os
 from agents.multi_agent_system import MultiAgentSystem
 from agents.base_agent import Agent
+from agents.early_exit import EarlyExitPolicy
 from mydatasets.base_dataset import BaseDataset
 
 class MDocAgent(MultiAgentSystem):
+    supports_early_exit = True
+
     def __init__(self, config):
         super().__init__(config)
-    
-    def predict(self, question, texts, images):
+        self.early_exit = None
+        if self.supports_early_exit:
+            self.early_exit = EarlyExitPolicy.from_config(getattr(config, "early_exit", None))
+
+    def load_inputs(self, dataset, sample):
+        inputs = super().load_inputs(dataset, sample)
+        if self.early_exit is not None:
+            inputs = (*inputs, dataset.load_sample_retrieval_scores(sample))
+        return inputs
+
+    def predict(self, question, texts, images, scores=None):
         general_agent = self.agents[-1]
         general_response, messages = general_agent.predict(question, texts, images, with_sys_prompt=True)
         # print("### General Agent: "+ general_response)
-        critical_info = general_agent.self_reflect(prompt = general_agent.config.agent.critical_prompt, add_to_message=False)
-        # print("### General Critical Agent: " + critical_info)
-
-        start_index = critical_info.find('{') 
-        end_index = critical_info.find('}') + 1 
-        critical_info = critical_info[start_index:end_index]
-        text_reflection = ""
-        image_reflection = ""
-        try:
-            critical_info = json.loads(critical_info)
-            text_reflection = critical_info.get("text", "")
-            image_reflection = critical_info.get("image", "")
-        except Exception as e:
-            print(e)
+        decision = None
+        if self.early_exit is not None:
+            specialist_response = None
+            if self.early_exit.mode == "agreement":
+                (specialist_response, _), = self.run_agents([self.specialist_call(question, texts, images)])
+                self.specialist_agent().clean_messages()
+            decision = self.early_exit.decide(general_response, scores, specialist_response)
+            if decision["skipped"]:
+                return general_response, messages, self.exit_record(decision, general_response)
+        text_reflection, image_reflection = self.critical_info(general_agent)
 
         text_agent = self.agents[1]
         image_agent = self.agents[0]
         all_messages = "General Agent:\n" + general_response + "\n"
         
         relect_prompt = "\nYou may use the given clue:\n"
-        text_response, messages = text_agent.predict(question + relect_prompt +text_reflection, texts = texts, images = None, with_sys_prompt=True)
+        # The text and image agents only depend on the general agent's clues, so they can run concurrently
+        (text_response, _), (image_response, _) = self.run_agents([
+            (text_agent, question + relect_prompt + text_reflection, texts, None),
+            (image_agent, question + relect_prompt + image_reflection, None, images),
+        ])
         all_messages += "Text Agent:\n" + text_response + "\n"
-        image_response, messages = image_agent.predict(question + relect_prompt +image_reflection, texts = None, images = images, with_sys_prompt=True)
         all_messages += "Image Agent:\n" + image_response + "\n"
             
         # print("### Text Agent: " + text_response)
         # print("### Image Agent: " + image_response)
         final_ans, final_messages = self.sum(all_messages)
         # print("### Final Answer: "+final_ans)
-        
+        if decision is not None:
+            return final_ans, final_messages, self.exit_record(decision, general_response)
         return final_ans, final_messages
+
+    def predict_batch(self, inputs):
+        questions = [inp[0] for inp in inputs]
+        texts_list = [inp[1] for inp in inputs]
+        images_list = [inp[2] for inp in inputs]
+        general_agent = self.agents[-1]
+        general_responses, histories = general_agent.predict_batch(questions, texts_list, images_list)
+        decisions = self.early_exit_batch(inputs, general_responses)
+        # Only the samples that did not exit early go through the remaining stages
+        full = [i for i, decision in enumerate(decisions) if decision is None or not decision["skipped"]]
+        outputs = [(general_responses[i], histories[i]) for i in range(len(inputs))]
+        if full:
+            critical_infos, _ = general_agent.self_reflect_batch(
+                [histories[i] for i in full], prompt=general_agent.config.agent.critical_prompt
+            )
+            reflections = [self.parse_critical_info(critical_info) for critical_info in critical_infos]
+
+            text_agent = self.agents[1]
+            image_agent = self.agents[0]
+            relect_prompt = "\nYou may use the given clue:\n"
+            # Like predict, the text and image stages run concurrently with concurrent_agents
+            (text_responses, _), (image_responses, _) = self.run_agents_batch([
+                (
+                    text_agent,
+                    [questions[i] + relect_prompt + text_reflection for i, (text_reflection, _) in zip(full, reflections)],
+                    [texts_list[i] for i in full],
+                    None,
+                ),
+                (
+                    image_agent,
+                    [questions[i] + relect_prompt + image_reflection for i, (_, image_reflection) in zip(full, reflections)],
+                    None,
+                    [images_list[i] for i in full],
+                ),
+            ])
+            sum_questions = [
+                "General Agent:\n" + general_responses[i] + "\n"
+                + "Text Agent:\n" + text_response + "\n"
+                + "Image Agent:\n" + image_response + "\n"
+                for i, text_response, image_response in zip(full, text_responses, image_responses)
+            ]
+            for i, output in zip(full, self.sum_batch(sum_questions)):
+                outputs[i] = output
+        return [
+            output if decision is None else (*output, self.exit_record(decision, general_response))
+            for output, decision, general_response in zip(outputs, decisions, general_responses)
+        ]
+
+    def specialist_agent(self):
+        return self.agents[1] if self.early_exit.specialist == "text" else self.agents[0]
+
+    def specialist_call(self, question, texts, images):
+        """The cheap specialist call whose answer is compared with the general agent's in agreement mode."""
+        if self.early_exit.specialist == "text":
+            return (self.agents[1], question, texts, None)
+        return (self.agents[0], question, None, images)
+
+    def early_exit_batch(self, inputs, general_responses):
+        if self.early_exit is None:
+            return [None] * len(inputs)
+        specialist_responses = [None] * len(inputs)
+        if self.early_exit.mode == "agreement":
+            calls = [self.specialist_call(*inp[:3]) for inp in inputs]
+            agent = self.specialist_agent()
+            specialist_responses, _ = agent.predict_batch(
+                [question for _, question, _, _ in calls],
+                texts_list=[texts for _, _, texts, _ in calls],
+                images_list=[images for _, _, _, images in calls],
+            )
+        return [
+            self.early_exit.decide(general_response, inp[3] if len(inp) > 3 else None, specialist_response)
+            for inp, general_response, specialist_response in zip(inputs, general_responses, specialist_responses)
+        ]
+
+    def exit_record(self, decision, general_response):
+        return {self.config.ans_key + "_early_exit": {**decision, "general_answer": general_response}}
+
+    def general_stage_batch(self, questions, texts_list, images_list):
+        """Run the general agent and its critical reflection for a whole batch."""
+        general_agent = self.agents[-1]
+        general_responses, histories = general_agent.predict_batch(questions, texts_list, images_list)
+        critical_infos, _ = general_agent.self_reflect_batch(histories, prompt=general_agent.config.agent.critical_prompt)
+        return general_responses, [self.parse_critical_info(critical_info) for critical_info in critical_infos]
+
+    def critical_info(self, general_agent):
+        """Ask the general agent for text/image clues and parse them from its JSON reply."""
+        critical_info = general_agent.self_reflect(prompt = general_agent.config.agent.critical_prompt, add_to_message=False)
+        # print("### General Critical Agent: " + critical_info)
+        return self.parse_critical_info(critical_info)
+
+    def parse_critical_info(self, critical_info):
+        start_index = critical_info.find('{') 
+        end_index = critical_info.find('}') + 1 
+        critical_info = critical_info[start_index:end_index]
+        text_reflection = ""
+        image_reflection = ""
+        try:
+            critical_info = json.loads(critical_info)
+            text_reflection = critical_info.get("text", "")
+            image_reflection = critical_info.get("image", "")
+        except Exception as e:
+            print(e)
+        return text_reflection, image_reflection
@@ -1,4 +1,6 @@
 from agents.base_agent import Agent
+from models.registry import registry, model_key
+from models.response_cache import open_stores
 from mydatasets.base_dataset import BaseDataset
 from tqdm import tqdm
 import importlib
@@ -6,26 +8,38 @@ import json
 import torch
 from typing import List
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 class MultiAgentSystem:
     def __init__(self, config):
         self.config = config
         self.agents:List[Agent] = []
         self.models:dict = {}
+        # Models come from the process-wide registry: agents with the same weights (model_key) share one
+        # instance, each passing its own generation settings per call, and a model is only loaded when
+        # one of its agents first predicts
         for agent_config in self.config.agents:
-            if agent_config.model.class_name not in self.models:
-                module = importlib.import_module(agent_config.model.module_name)
-                model_class = getattr(module, agent_config.model.class_name)
-                print("Create model: ", agent_config.model.class_name)
-                self.models[agent_config.model.class_name] = model_class(agent_config.model)
-            self.add_agent(agent_config, self.models[agent_config.model.class_name])
-            
-        if config.sum_agent.model.class_name not in self.models:
-            module = importlib.import_module(config.sum_agent.model.module_name)
-            model_class = getattr(module, config.sum_agent.model.class_name)
-            self.models[config.sum_agent.model.class_name] = model_class(config.sum_agent.model)
-        self.sum_agent = Agent(config.sum_agent, self.models[config.sum_agent.model.class_name])
+            self.add_agent(agent_config, self.acquire_model(agent_config.model))
+        self.sum_agent = Agent(config.sum_agent, self.acquire_model(config.sum_agent.model))
+        # Agents backed by the same model instance never generate at the same time
+        self.model_locks = {id(model): threading.Lock() for model in self.models.values()}
+        self.executor = None
         
+    def acquire_model(self, model_config):
+        model = registry.acquire(model_config)
+        self.models[model_key(model_config)] = model
+        return model
+
+    def close(self):
+        """Release this system's models and worker threads; models no other user holds are unloaded."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        for agent in self.agents + [self.sum_agent]:
+            registry.release(agent.model)
+        self.models = {}
+
     def add_agent(self, agent_config, model):
         module = importlib.import_module(agent_config.agent.module_name)
         agent_class = getattr(module, agent_config.agent.class_name)
@@ -35,37 +49,146 @@ class MultiAgentSystem:
     def predict(self, question, texts, images):
         '''Implement the method in the subclass'''
         pass
+
+    def predict_batch(self, inputs):
+        '''Predict a batch of load_inputs tuples; subclasses advance the batch stage by stage.'''
+        outputs = []
+        for sample_inputs in inputs:
+            outputs.append(self.predict(*sample_inputs))
+            self.clean_messages()
+        return outputs
+
+    def load_inputs(self, dataset, sample):
+        '''Arguments of predict for one sample: (question, texts, images), subclasses may append more.'''
+        return dataset.load_sample_retrieval_data(sample)
     
+    def run_agents(self, calls):
+        '''Run independent agent calls and return their (response, messages) in call order.
+
+        :param calls: list of (agent, question, texts, images) tuples.
+        With mdoc_agent.concurrent_agents the calls are dispatched to a thread pool;
+        calls that share a model are still serialized by that model's lock.
+        '''
+        return self._dispatch(self._run_agent, calls)
+
+    def run_agents_batch(self, calls):
+        '''Batched run_agents: calls are (agent, questions, texts_list, images_list), each one agent.predict_batch.'''
+        return self._dispatch(self._run_agent_batch, calls)
+
+    def _dispatch(self, run, calls):
+        if not getattr(self.config, "concurrent_agents", False) or len(calls) <= 1:
+            return [run(*call) for call in calls]
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.agents))
+        futures = [self.executor.submit(run, *call) for call in calls]
+        return [future.result() for future in futures]
+
+    def _run_agent(self, agent, question, texts, images):
+        lock = self.model_locks.setdefault(id(agent.model), threading.Lock())
+        with lock:
+            return agent.predict(question, texts=texts, images=images, with_sys_prompt=True)
+
+    def _run_agent_batch(self, agent, questions, texts_list, images_list):
+        lock = self.model_locks.setdefault(id(agent.model), threading.Lock())
+        with lock:
+            return agent.predict_batch(questions, texts_list=texts_list, images_list=images_list)
+
     def sum(self, sum_question):
         ans, all_messages = self.sum_agent.predict(sum_question)
-        def extract_final_answer(agent_response):
-            try:
-                response_dict = json.loads(agent_response)
-                answer = response_dict.get("Answer", None)
-                return answer
-            except:
-                return agent_response
         final_ans = extract_final_answer(ans)
         return final_ans, all_messages
 
+    def sum_batch(self, sum_questions):
+        answers, messages_list = self.sum_agent.predict_batch(sum_questions)
+        return [(extract_final_answer(ans), messages) for ans, messages in zip(answers, messages_list)]
+
     def predict_dataset(self, dataset:BaseDataset, resume_path = None):
+        # save_format: jsonl appends each finished sample to <run-time>.jsonl (resume with that path),
+        # json rewrites the whole result file every save_freq samples
+        use_log = getattr(self.config, "save_format", "json") == "jsonl"
+        resume_log = resume_path is not None and resume_path.endswith(".jsonl")
         samples = dataset.load_data(use_retreival=True)
-        if resume_path:
+        if resume_path and not resume_log:
             assert os.path.exists(resume_path)
             with open(resume_path, 'r') as f:
                 samples = json.load(f)
         if self.config.truncate_len:
             samples = samples[:self.config.truncate_len]
-            
+
+        log = None
+        done = set()
+        if use_log or resume_log:
+            log_path = resume_path if resume_log else dataset.results_log_path()
+            done = dataset.merge_results_log(samples, log_path)
+            log = dataset.open_results_log(log_path)
+            print(f"Append results to {log_path} ({len(done)} samples already done).")
+
+        pending = [
+            (sample_idx, sample) for sample_idx, sample in enumerate(samples)
+            if sample_idx not in done and not (resume_path and self.config.ans_key in sample)
+        ]
+        # batch_size > 1 moves that many samples through each agent stage together
+        batch_size = getattr(self.config, "batch_size", 1) or 1
         sample_no = 0
-        for sample in tqdm(samples):
-            if resume_path and self.config.ans_key in sample:
-                continue
-            question, texts, images = dataset.load_sample_retrieval_data(sample)
+        pbar = tqdm(total=len(pending))
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start+batch_size]
+            inputs = [self.load_inputs(dataset, sample) for _, sample in batch]
             try:
-                final_ans, final_messages = self.predict(question, texts, images)
+                if batch_size == 1:
+                    outputs = [self.predict(*inputs[0])]
+                else:
+                    outputs = self.predict_batch(inputs)
             except RuntimeError as e:
                 print(e)
                 if "out of memory" in str(e):
-                    torch.cuda.empty_cache()
-                final_ans, final_messages = Non
\ No newline at end of file
+                    for model in registry.loaded_models():
+                        model.clean_up(force=True)
+                outputs = [(None, None)] * len(batch)
+            self.clean_messages()
+
+            for (sample_idx, sample), output in zip(batch, outputs):
+                # predict returns (answer, messages), optionally followed by extra fields for the record
+                final_ans, final_messages, *extra = output
+                record = {self.config.ans_key: final_ans}
+                if self.config.save_message:
+                    record[self.config.ans_key+"_message"] = final_messages
+                for fields in extra:
+                    record.update(fields)
+                sample.update(record)
+
+                sample_no += 1
+                if log is not None:
+                    log.write({"_index": sample_idx, **record})
+                elif sample_no % self.config.save_freq == 0:
+                    path = dataset.dump_reults(samples)
+                    print(f"Save {sample_no} results to {path}.")
+            pbar.update(len(batch))
+            if getattr(self.config, "model_idle_seconds", None):
+                registry.unload_idle(self.config.model_idle_seconds)
+        pbar.close()
+        if getattr(self, "early_exit", None) is not None:
+            print(f"Early exit: {self.early_exit.exits}/{self.early_exit.decisions} samples"
+                  + (" (shadow)" if self.early_exit.shadow else ""))
+        for path, store in open_stores().items():
+            print(f"Response cache {path}: {store.stats()}")
+        for key, model in self.models.items():
+            if model.loaded:
+                print(f"Memory {key[1]} {key[2]}: {model.memory.summary()}")
+        if log is not None:
+            log.close()
+        path = dataset.dump_reults(samples)
+        print(f"Save final results to {path}.")
+
+    def clean_messages(self):
+        for agent in self.agents:
+            agent.clean_messages()
+        self.sum_agent.clean_messages()
+
+def extract_final_answer(agent_response):
+    try:
+        response_dict = json.loads(agent_response)
+        answer = response_dict.get("Answer", None)
+        return answer
+    except:
+        return agent_response
@@ -1,4 +1,5 @@
 import torch
+from models.memory import MemoryBudget
 class BaseModel():
     def __init__(self, config):
         """
@@ -6,12 +7,58 @@ class BaseModel():
         :param config: A dictionary containing model configuration parameters.
         """
         self.config = config
+        self.memory = MemoryBudget.from_config(config)
         
-    def predict(self, question, texts = None, images = None, history = None):
+    def predict(self, question, texts = None, images = None, history = None, max_new_tokens = None, temperature = None):
         pass
+
+    def predict_batch(self, questions, texts_list = None, images_list = None, histories = None, **kwargs):
+        """
+        Generate answers for several independent prompts; returns (answers, messages_list).
+        Models that can pad and generate a whole batch at once override this.
+        kwargs (e.g. max_new_tokens) are passed on to every predict call.
+        """
+        n = len(questions)
+        texts_list = texts_list or [None] * n
+        images_list = images_list or [None] * n
+        histories = histories or [None] * n
+        answers, messages_list = [], []
+        for question, texts, images, history in zip(questions, texts_list, images_list, histories):
+            answer, messages = self.predict(question, texts, images, history, **kwargs)
+            answers.append(answer)
+            messages_list.append(messages)
+        return answers, messages_list
     
-    def clean_up(self):
-        torch.cuda.empty_cache()
+    def generation_settings(self, max_new_tokens = None, temperature = None):
+        """Per-call generation settings, falling back to the config this instance was loaded with."""
+        if max_new_tokens is None:
+            max_new_tokens = self.config.max_new_tokens
+        if temperature is None:
+            temperature = self.config.temperature
+        return max_new_tokens, temperature
+
+    def create_system_message(self, prompt):
+        return {
+            "role": "system",
+            "content": [
+                {"type": "text", "text": prompt},
+            ],
+        }
+
+    def cache_prefix(self, messages):
+        """
+        Hint that conversations will start with `messages` (e.g. an agent's system message).
+        Local models prefill them once and reuse the KV cache; the default does nothing.
+        """
+        pass
+
+    def clean_up(self, force=False):
+        # Emptying the allocator cache on every call costs a sync and re-allocation,
+        # so cached memory is only given back when it gets close to the budget
+        if force:
+            self.memory.release()
+        else:
+            self.memory.release_if_needed()
         
     def process_message(self, question, texts, images, history):
         if history is not None:
@@ -0,0 +1,48 @@
+class ImageBudget():
+    """Splits a visual-token budget across the retrieved pages of one call.
+
+    Pages arrive in retrieval order; the top-ranked page gets top_page_share of the
+    budget (at least an even share), the rest is split evenly, and every page stays
+    within [min_pixels, max_pixels]. Without visual_token_budget each page is only
+    capped at max_pixels.
+    """
+    def __init__(self, min_pixels=None, max_pixels=None, visual_token_budget=None, top_page_share=0.5,
+                 pixels_per_token=28 * 28):
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.visual_token_budget = visual_token_budget
+        self.top_page_share = top_page_share
+        self.pixels_per_token = pixels_per_token
+
+    @classmethod
+    def from_config(cls, config):
+        """Budget from a model config, or None if it sets no pixel limits."""
+        keys = ("min_pixels", "max_pixels", "visual_token_budget")
+        if all(getattr(config, key, None) is None for key in keys):
+            return None
+        return cls(
+            min_pixels=getattr(config, "min_pixels", None),
+            max_pixels=getattr(config, "max_pixels", None),
+            visual_token_budget=getattr(config, "visual_token_budget", None),
+            top_page_share=getattr(config, "top_page_share", 0.5),
+        )
+
+    def clip(self, pixels):
+        if self.max_pixels is not None:
+            pixels = min(pixels, self.max_pixels)
+        if self.min_pixels is not None:
+            pixels = max(pixels, self.min_pixels)
+        return int(pixels)
+
+    def allocate(self, n_pages):
+        """max_pixels for each of n_pages pages, in retrieval order."""
+        if n_pages == 0:
+            return []
+        if self.visual_token_budget is None:
+            return [self.max_pixels] * n_pages
+        total = self.visual_token_budget * self.pixels_per_token
+        if n_pages == 1:
+            return [self.clip(total)]
+        top = total * max(self.top_page_share, 1 / n_pages)
+        rest = (total - top) / (n_pages - 1)
+        return [self.clip(top)] + [self.clip(rest)] * (n_pages - 1)
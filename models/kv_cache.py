@@ -0,0 +1,110 @@
+import copy
+from collections import OrderedDict
+import torch
+
+
+class PrefixKVCache():
+    """LRU of prefilled token sequences and their KV caches.
+
+    After a generation the model stores the tokens it has seen together with
+    the ``past_key_values`` covering them; a later prompt that starts with the
+    same tokens (e.g. the follow-up turn of a conversation) only needs prefill
+    for the part after the longest shared prefix. Token ids alone do not
+    identify an image (every page of the same size is the same run of pad
+    tokens), so callers pass the ref and token span of each image and the
+    shared prefix ends before the first image that differs.
+
+    An ordinary entry that shares most of its tokens with the new prompt is
+    handed out and replaced by the follow-up's own cache; one that only shares
+    a short head (e.g. the chat-template header) is copied, so other
+    conversations stay cached. Pinned entries (such as a constant system-prompt
+    prefix) are copied on every use and never evicted.
+    """
+    def __init__(self, max_entries=1, min_prefix=1, min_copy_prefix=64):
+        self.max_entries = max_entries
+        self.min_prefix = min_prefix
+        # Copying a whole cache to reuse a few header tokens costs more than prefilling them
+        self.min_copy_prefix = min_copy_prefix
+        self.entries = OrderedDict()
+        self.pinned = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self._next_key = 0
+
+    @staticmethod
+    def common_prefix(a, b):
+        n = min(a.shape[0], b.shape[0])
+        mismatch = (a[:n] != b[:n]).nonzero()
+        return int(mismatch[0]) if mismatch.numel() else n
+
+    @staticmethod
+    def cut_at_changed_image(prefix_len, cached_images, images):
+        """Shorten prefix_len to the start of the first image that is not the same in both prompts.
+
+        :param cached_images, images: lists of (ref, start, end) in prompt order.
+        """
+        for index, (ref, start, end) in enumerate(images):
+            if start >= prefix_len:
+                break
+            if index >= len(cached_images) or tuple(cached_images[index]) != (ref, start, end):
+                return start
+        return prefix_len
+
+    def lookup(self, input_ids, images=None):
+        """Find the entry sharing the longest prefix with ``input_ids`` (1-D tensor).
+
+        :param images: (ref, start, end) of every image in ``input_ids``; the ref has to identify
+            the image content and resolution.
+        :return: (past_key_values cropped to the shared prefix, extra dict, prefix length),
+            or (None, None, 0) when nothing useful is cached.
+        """
+        input_ids = input_ids.cpu()
+        best_key, best_len, best_pinned = None, 0, False
+        for pinned, entries in ((True, self.pinned), (False, self.entries)):
+            for key, entry in entries.items():
+                prefix_len = self.common_prefix(entry["ids"], input_ids)
+                prefix_len = self.cut_at_changed_image(prefix_len, entry["extra"].get("images", []), images or [])
+                if prefix_len > best_len:
+                    best_key, best_len, best_pinned = key, prefix_len, pinned
+        # At least one token has to go through the model to produce logits
+        best_len = min(best_len, input_ids.shape[0] - 1)
+        consume = not best_pinned and best_key is not None and 2 * best_len >= self.entries[best_key]["ids"].shape[0]
+        min_len = self.min_prefix if consume else max(self.min_prefix, self.min_copy_prefix)
+        if best_key is None or best_len < min_len:
+            self.misses += 1
+            return None, None, 0
+
+        if consume:
+            entry = self.entries.pop(best_key)
+            past_key_values = entry["cache"]
+        else:
+            # Pinned, or mostly a different conversation that stays cached for its own follow-up
+            entry = (self.pinned if best_pinned else self.entries)[best_key]
+            past_key_values = copy.deepcopy(entry["cache"])
+        past_key_values.crop(best_len)
+        self.hits += 1
+        self.reused_tokens += best_len
+        return past_key_values, entry["extra"], best_len
+
+    def store(self, ids, past_key_values, extra=None, pinned=False):
+        """Remember ``past_key_values`` for the first ``past_key_values.get_seq_length()`` tokens of ``ids``."""
+        seq_len = past_key_values.get_seq_length()
+        entry = {"ids": ids[:seq_len].detach().cpu(), "cache": past_key_values, "extra": extra or {}}
+        key = self._next_key
+        self._next_key += 1
+        if pinned:
+            self.pinned[key] = entry
+            return key
+        if self.max_entries <= 0:
+            return None
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return key
+
+    def clear(self, pinned=False):
+        self.entries.clear()
+        if pinned:
+            self.pinned.clear()
+        torch.cuda.empty_cache()
@@ -1,4 +1,5 @@
 from models.base_model import BaseModel
+from models.kv_cache import PrefixKVCache
 import torch
 import transformers
 
@@ -20,6 +21,16 @@ class Llama3(BaseModel):
             model_kwargs={"torch_dtype": torch.bfloat16},
             device=1,
         )
+        self.prefix_cache = None
+        if getattr(self.config, "kv_cache_size", 0) > 0:
+            self.prefix_cache = PrefixKVCache(max_entries=self.config.kv_cache_size)
+        self.pinned_prefixes = set()
+
+    def create_system_message(self, prompt):
+        return {
+            "role": "system",
+            "content": prompt,
+        }
     
     def create_text_message(self, texts, question): 
         prompt = ""
@@ -32,16 +43,81 @@ class Llama3(BaseModel):
         return message
     
     @torch.no_grad()
-    def predict(self, question, texts = None, images = None, history = None):
-        self.clean_up()
+    def cache_prefix(self, messages):
+        tokenizer = self.pipeline.tokenizer
+        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+        if text in self.pinned_prefixes:
+            return
+        if self.prefix_cache is None:
+            self.prefix_cache = PrefixKVCache(max_entries=getattr(self.config, "kv_cache_size", 0))
+        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=False, return_tensors="pt")
+        outputs = self.pipeline.model(input_ids=input_ids.to(self.pipeline.model.device), use_cache=True)
+        self.prefix_cache.store(input_ids[0], outputs.past_key_values, pinned=True)
+        self.pinned_prefixes.add(text)
+
+    @torch.no_grad()
+    def predict(self, question, texts = None, images = None, history = None, max_new_tokens = None, temperature = None):
+        max_new_tokens, _ = self.generation_settings(max_new_tokens, temperature)
         messages = self.process_message(question, texts, images, history)
-        outputs = self.pipeline(
-            messages,
-            max_new_tokens=self.config.max_new_tokens,
-            pad_token_id=self.pipeline.tokenizer.eos_token_id,
-        )
-        self.clean_up()
+        with self.memory.track(self.memory.estimate_tokens(history=messages)):
+            if self.prefix_cache is not None:
+                answer = self.generate_with_cache(messages, max_new_tokens)
+                messages.append(self.create_ans_message(answer))
+                return answer, messages
+            outputs = self.pipeline(
+                messages,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.pipeline.tokenizer.eos_token_id,
+            )
         return outputs[0]["generated_text"][-1]['content'], outputs[0]["generated_text"]
+
+    def generate_with_cache(self, messages, max_new_tokens):
+        # Same prompt and generation settings as the pipeline, but generate() gets the cached prefix
+        # and only prefills the tokens after it
+        tokenizer = self.pipeline.tokenizer
+        model = self.pipeline.model
+        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+        past_key_values, _, _ = self.prefix_cache.lookup(input_ids[0])
+        input_ids = input_ids.to(model.device)
+        kwargs = {} if past_key_values is None else {"past_key_values": past_key_values}
+        outputs = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.eos_token_id,
+            return_dict_in_generate=True,
+            **kwargs,
+        )
+        self.prefix_cache.store(outputs.sequences[0], outputs.past_key_values)
+        return tokenizer.decode(outputs.sequences[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+    @torch.no_grad()
+    def predict_batch(self, questions, texts_list = None, images_list = None, histories = None, max_new_tokens = None, temperature = None):
+        max_new_tokens, _ = self.generation_settings(max_new_tokens, temperature)
+        n = len(questions)
+        texts_list = texts_list or [None] * n
+        images_list = images_list or [None] * n
+        histories = histories or [None] * n
+        messages_list = [
+            self.process_message(question, texts, images, history)
+            for question, texts, images, history in zip(questions, texts_list, images_list, histories)
+        ]
+        token_counts = [self.memory.estimate_tokens(history=messages) for messages in messages_list]
+        # Llama has no pad token; pad on the left with eos so generation continues each prompt
+        self.pipeline.tokenizer.pad_token_id = self.pipeline.tokenizer.eos_token_id
+        self.pipeline.tokenizer.padding_side = "left"
+        outputs = []
+        # Generate as many conversations together as the memory budget allows
+        for batch in self.memory.plan_batches(token_counts):
+            with self.memory.track(sum(token_counts[i] for i in batch)):
+                outputs += self.pipeline(
+                    [messages_list[i] for i in batch],
+                    batch_size=len(batch),
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=self.pipeline.tokenizer.eos_token_id,
+                )
+        answers = [output[0]["generated_text"][-1]['content'] for output in outputs]
+        return answers, [output[0]["generated_text"] for output in outputs]
         
     def is_valid_history(self, history):
         if not isinstance(history, list):
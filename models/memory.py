@@ -0,0 +1,224 @@
+import gc
+import os
+import resource
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from PIL import Image
+import torch
+
+MB = 1024 * 1024
+
+# Peak memory stats are per process (RSS) or per device (CUDA), not per model, so calls of
+# different models tracked at the same time see each other's allocations
+_track_lock = threading.Lock()
+_active_calls = {}
+
+
+def process_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def image_pixels(image):
+    if isinstance(image, str):
+        # Only the header is read
+        with Image.open(image) as img:
+            width, height = img.size
+    else:
+        width, height = image.size
+    return width * height
+
+
+class MemoryBudget():
+    """Keeps a model's generation calls within a memory budget.
+
+    Inputs are costed in tokens (text characters / 4 plus image pixels / pixels_per_token).
+    A call needs a fixed amount plus bytes_per_token per token on top of what is allocated
+    already, on the most loaded device. Both start from the configured per-token value and
+    are refitted by least squares over the recent calls; the fixed part is then raised so
+    every observed call is covered. Batches are split to fit the free budget; page
+    resolution is only lowered when ``memory_budget_mb`` is set explicitly (``enabled``),
+    so answers do not depend on run history by default. Cached allocator blocks are only
+    released when reserved memory gets close to the budget. On CPU the process RSS is
+    tracked instead. A call that overlapped another tracked call (e.g. with
+    concurrent_agents) is not used for fitting, as its peak includes the other call.
+    """
+    def __init__(self, budget_mb=None, bytes_per_token=256 * 1024, release_fraction=0.9,
+                 pixels_per_token=28 * 28, history_size=1000, min_fit_calls=8):
+        self.use_cuda = torch.cuda.is_available()
+        self.enabled = bool(budget_mb)
+        # Per device: model layers and activations are spread over GPUs, each has to fit on its own
+        self.budget = budget_mb * MB if budget_mb else int(self.device_memory() * 0.9)
+        self.bytes_per_token = bytes_per_token
+        self.fixed_bytes = 0
+        self.release_fraction = release_fraction
+        self.pixels_per_token = pixels_per_token
+        self.min_fit_calls = min_fit_calls
+        self.calls = 0
+        self.releases = 0
+        self.downscales = 0
+        self.overlapped = 0
+        self.peak = 0
+        self.history = deque(maxlen=history_size)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            budget_mb=getattr(config, "memory_budget_mb", None),
+            bytes_per_token=getattr(config, "memory_bytes_per_token", 256 * 1024),
+            release_fraction=getattr(config, "memory_release_fraction", 0.9),
+        )
+
+    def devices(self):
+        return range(torch.cuda.device_count())
+
+    def device_memory(self):
+        if self.use_cuda:
+            return min(torch.cuda.get_device_properties(device).total_memory for device in self.devices())
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    def allocated_per_device(self):
+        if self.use_cuda:
+            return [torch.cuda.memory_allocated(device) for device in self.devices()]
+        return [process_rss()]
+
+    def allocated(self):
+        return sum(self.allocated_per_device())
+
+    def reserved(self):
+        if self.use_cuda:
+            return max(torch.cuda.memory_reserved(device) for device in self.devices())
+        return process_rss()
+
+    def free(self):
+        return max(self.budget - max(self.allocated_per_device()), 0)
+
+    def cost(self, tokens):
+        """Estimated extra memory of one call over tokens input tokens."""
+        return self.fixed_bytes + tokens * self.bytes_per_token
+
+    def estimate_tokens(self, texts=None, images=None, history=None, max_pixels=None):
+        """Rough input size of one call in tokens."""
+        chars = sum(len(text) for text in texts or [])
+        pixels = 0
+        for image in images or []:
+            pixels += min(image_pixels(image), max_pixels) if max_pixels else image_pixels(image)
+        for message in history or []:
+            contents = message["content"] if isinstance(message["content"], list) else [{"text": message["content"]}]
+            for content in contents:
+                chars += len(content.get("text", ""))
+                if content.get("type") == "image":
+                    image_size = image_pixels(content["image"])
+                    pixels += min(image_size, content["max_pixels"]) if content.get("max_pixels") else image_size
+        return chars // 4 + pixels // self.pixels_per_token
+
+    def fits(self, tokens):
+        return self.cost(tokens) <= self.free()
+
+    def plan_batches(self, token_counts):
+        """Split consecutive inputs into batches whose estimated memory fits the free budget."""
+        free = self.free()
+        batches, batch, batch_tokens = [], [], 0
+        for index, tokens in enumerate(token_counts):
+            if batch and self.cost(batch_tokens + tokens) > free:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(index)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def fit_pixels(self, images, other_tokens=0):
+        """Per-image max_pixels that keeps one call within the free budget, or None if it fits as is."""
+        pixels = sum(image_pixels(image) for image in images)
+        if not pixels:
+            return None
+        affordable = (self.free() - self.fixed_bytes) // self.bytes_per_token - other_tokens
+        if pixels // self.pixels_per_token <= affordable:
+            return None
+        scale = max(affordable, 0) * self.pixels_per_token / pixels
+        # Never go below a few hundred visual tokens per page
+        return max(int(scale * pixels / len(images)), 256 * self.pixels_per_token)
+
+    def release(self):
+        gc.collect()
+        if self.use_cuda:
+            torch.cuda.empty_cache()
+        self.releases += 1
+
+    def release_if_needed(self):
+        if self.reserved() > self.release_fraction * self.budget:
+            self.release()
+
+    def refit(self):
+        """Least-squares fixed cost and per-token slope over the recent calls."""
+        points = [(record["tokens"], record["bytes"]) for record in self.history if record["tokens"] > 0]
+        if len(points) >= self.min_fit_calls:
+            mean_tokens = sum(tokens for tokens, _ in points) / len(points)
+            mean_bytes = sum(used for _, used in points) / len(points)
+            variance = sum((tokens - mean_tokens) ** 2 for tokens, _ in points)
+            if variance > 0:
+                covariance = sum((tokens - mean_tokens) * (used - mean_bytes) for tokens, used in points)
+                self.bytes_per_token = max(int(covariance / variance), 1)
+        # Cover every observed call, a short call with large overhead raises the fixed part only
+        self.fixed_bytes = max([0] + [int(used - tokens * self.bytes_per_token) for tokens, used in points])
+
+    @contextmanager
+    def track(self, tokens=0):
+        """Record the peak memory of one call and release cached memory afterwards if under pressure."""
+        call = object()
+        with _track_lock:
+            # Whoever is running already and this call measure each other's memory too
+            overlapped = bool(_active_calls)
+            for other in _active_calls:
+                _active_calls[other] = True
+            _active_calls[call] = overlapped
+            if self.use_cuda and not overlapped:
+                for device in self.devices():
+                    torch.cuda.reset_peak_memory_stats(device)
+            peak_before = None if self.use_cuda else peak_rss()
+            base = self.allocated_per_device()
+        start = time.time()
+        try:
+            yield
+        finally:
+            with _track_lock:
+                if self.use_cuda:
+                    peaks = [torch.cuda.max_memory_allocated(device) for device in self.devices()]
+                else:
+                    rss = process_rss()
+                    peaks = [max(rss, peak_rss()) if peak_rss() > peak_before else rss]
+                overlapped = _active_calls.pop(call)
+                self.calls += 1
+                self.peak = max(self.peak, max(peaks))
+                if overlapped:
+                    self.overlapped += 1
+                else:
+                    used = max(max(peak - before, 0) for peak, before in zip(peaks, base))
+                    self.history.append({"tokens": tokens, "bytes": used, "peak_mb": max(peaks) / MB, "seconds": time.time() - start})
+                    self.refit()
+            self.release_if_needed()
+
+    def summary(self):
+        return {
+            "calls": self.calls,
+            "peak_mb": round(self.peak / MB, 1),
+            "budget_mb": round(self.budget / MB, 1),
+            "bytes_per_token": self.bytes_per_token,
+            "fixed_mb": round(self.fixed_bytes / MB, 1),
+            "downscales": self.downscales,
+            "overlapped": self.overlapped,
+            "releases": self.releases,
+        }
@@ -1,17 +1,128 @@
 from models.base_model import BaseModel
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError, InternalServerError, APIConnectionError, APITimeoutError
+import asyncio
 import base64
+import collections
+import hashlib
+import httpx
+import io
+import math
+import os
+import random
+import threading
+import time
+from PIL import Image
 
 def encode_image(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode("utf-8")
 
+def image_mime_type(data):
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/png"
+
+def encode_image_bytes(data, max_pixels=None, quality=90):
+    """Return (mime_type, base64 payload); images above max_pixels are downscaled and re-encoded as JPEG."""
+    if max_pixels is not None:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            if width * height > max_pixels:
+                scale = math.sqrt(max_pixels / (width * height))
+                size = (max(1, int(width * scale)), max(1, int(height * scale)))
+                buffer = io.BytesIO()
+                image.convert("RGB").resize(size, Image.LANCZOS).save(buffer, format="JPEG", quality=quality)
+                data = buffer.getvalue()
+    return image_mime_type(data), base64.b64encode(data).decode("utf-8")
+
+def image_tokens(width, height):
+    """Prompt tokens of one high-detail image: 85 plus 170 per 512px tile after the API's resizing."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def image_url_tokens(url):
+    """image_tokens of an image_url part; only the image header of a data URL is parsed."""
+    if url.startswith("data:"):
+        try:
+            with Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))) as image:
+                return image_tokens(*image.size)
+        except (ValueError, OSError):
+            pass
+    # Remote or unreadable image: a 1024x1024 page
+    return image_tokens(1024, 1024)
+
+class EncodedImageCache():
+    """Bounded LRU of encoded image payloads, addressed by the hash of the image bytes.
+
+    A (path, mtime, size) -> digest map lets repeated lookups of an unchanged
+    file skip reading it; identical pages stored under different paths still
+    share one entry.
+    """
+    def __init__(self, max_bytes, max_pixels=None, quality=90):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.quality = quality
+        self.payloads = collections.OrderedDict()
+        self.digests = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, image_path):
+        """Return (mime_type, base64 payload) for an image file."""
+        stat = os.stat(image_path)
+        file_key = (os.path.realpath(image_path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.digests.get(file_key)
+            if digest is not None and digest in self.payloads:
+                self.payloads.move_to_end(digest)
+                self.hits += 1
+                return self.payloads[digest]
+
+        with open(image_path, "rb") as image_file:
+            data = image_file.read()
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.digests[file_key] = digest
+            if len(self.digests) > 4 * len(self.payloads) + 1024:
+                self.digests.popitem(last=False)
+            if digest in self.payloads:
+                self.payloads.move_to_end(digest)
+                self.hits += 1
+                return self.payloads[digest]
+        payload = encode_image_bytes(data, self.max_pixels, self.quality)
+        with self.lock:
+            self.misses += 1
+            if digest not in self.payloads:
+                self.payloads[digest] = payload
+                self.size += len(payload[1])
+                while self.size > self.max_bytes and len(self.payloads) > 1:
+                    _, (_, evicted) = self.payloads.popitem(last=False)
+                    self.size -= len(evicted)
+        return payload
+
 class MyOpenAI(BaseModel):
     def __init__(self, config):
         super().__init__(config)
         self.model = self.config.model
         self.client = OpenAI(
             api_key=self.config.api_key,
+            base_url=getattr(self.config, "base_url", None),
+        )
+        self.image_cache = EncodedImageCache(
+            max_bytes=getattr(self.config, "image_cache_mb", 256) * 1024 * 1024,
+            max_pixels=getattr(self.config, "image_max_pixels", None),
+            quality=getattr(self.config, "image_jpeg_quality", 90),
         )
         self.create_ask_message = lambda question: {
             "role": "user",
@@ -40,7 +151,8 @@ class MyOpenAI(BaseModel):
     def create_image_message(self, images, question):
         content = []
         for image_path in images:
-            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encode_image(image_path)}"}})
+            mime_type, payload = self.image_cache.get(image_path)
+            content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{payload}"}})
         content.append({"type": "text", "text": question})
         message = {
             "role": "user",
@@ -48,13 +160,14 @@ class MyOpenAI(BaseModel):
         }
         return message
     
-    def predict(self, question, texts = None, images = None, history = None):
+    def predict(self, question, texts = None, images = None, history = None, max_new_tokens = None, temperature = None):
+        max_new_tokens, temperature = self.generation_settings(max_new_tokens, temperature)
         messages = self.process_message(question, texts, images, history)
         response = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
-            temperature=self.config.temperature,
-            max_tokens=self.config.max_new_tokens,
+            temperature=temperature,
+            max_tokens=max_new_tokens,
         )
         result = response.choices[0].message.content
         messages.append(self.create_ans_message(result))
@@ -78,4 +191,133 @@ class MyOpenAI(BaseModel):
                 if content["type"] not in content:
                     return False
         return True
-    
\ No newline at end of file
+
+
+class TokenBudget():
+    """Sliding one-minute token budget shared by all in-flight requests."""
+    def __init__(self, tokens_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self.window = collections.deque()
+        self.used = 0
+        self.lock = asyncio.Lock()
+
+    def _expire(self, now):
+        while self.window and now - self.window[0][0] >= 60:
+            self.used -= self.window.popleft()[1]
+
+    async def acquire(self, tokens):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                # A single request larger than the budget is let through once the window is empty
+                if self.used + tokens <= self.tokens_per_minute or not self.window:
+                    self.window.append((now, tokens))
+                    self.used += tokens
+                    return
+                await asyncio.sleep(60 - (now - self.window[0][0]))
+
+    def settle(self, estimated, actual):
+        """Replace an estimate with the usage reported by the API."""
+        self.window.append((time.monotonic(), actual - estimated))
+        self.used += actual - estimated
+
+
+class AsyncMyOpenAI(MyOpenAI):
+    """MyOpenAI with an asyncio ``apredict`` for running many requests at once.
+
+    Requests share one pooled HTTP client, at most ``max_concurrency`` are in
+    flight, 429/5xx/connection errors are retried with jittered exponential
+    backoff (honouring ``Retry-After``), and ``tokens_per_minute`` caps the
+    estimated prompt + completion tokens sent per minute. ``base_url`` can
+    point the client at a local stub server.
+    """
+    RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError, APITimeoutError)
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_concurrency = getattr(self.config, "max_concurrency", 16)
+        self.max_retries = getattr(self.config, "max_retries", 6)
+        self.backoff_base = getattr(self.config, "backoff_base", 1.0)
+        self.backoff_max = getattr(self.config, "backoff_max", 60.0)
+        self.tokens_per_minute = getattr(self.config, "tokens_per_minute", None)
+        self.async_client = None
+        self.semaphore = None
+        self.token_budget = None
+        self._loop = None
+
+    def _init_async(self):
+        # Async primitives are bound to the running event loop, create them lazily inside it
+        loop = asyncio.get_running_loop()
+        if self.async_client is not None and self._loop is loop:
+            return
+        self._loop = loop
+        self.async_client = AsyncOpenAI(
+            api_key=self.config.api_key,
+            base_url=getattr(self.config, "base_url", None),
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+                timeout=getattr(self.config, "timeout", 120),
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.token_budget = TokenBudget(self.tokens_per_minute) if self.tokens_per_minute else None
+
+    def estimate_tokens(self, messages, max_new_tokens):
+        # Rough upper bound: ~4 characters of text per token, images by their tile count
+        # (their base64 payload is not text), a few tokens of framing per message, plus the completion budget
+        chars, tokens = 0, max_new_tokens
+        for message in messages:
+            tokens += 4
+            contents = message["content"] if isinstance(message["content"], list) else [{"text": message["content"]}]
+            for content in contents:
+                if content.get("type") == "image_url":
+                    tokens += image_url_tokens(content["image_url"]["url"])
+                else:
+                    chars += len(content.get("text", ""))
+        return chars // 4 + tokens
+
+    def retry_delay(self, error, attempt):
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            if retry_after is not None:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    pass
+        return min(self.backoff_max, self.backoff_base * 2 ** attempt) * (0.5 + random.random())
+
+    async def apredict(self, question, texts = None, images = None, history = None, max_new_tokens = None, temperature = None):
+        self._init_async()
+        max_new_tokens, temperature = self.generation_settings(max_new_tokens, temperature)
+        messages = self.process_message(question, texts, images, history)
+        estimated = self.estimate_tokens(messages, max_new_tokens)
+        async with self.semaphore:
+            if self.token_budget is not None:
+                await self.token_budget.acquire(estimated)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await self.async_client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_new_tokens,
+                    )
+                    break
+                except self.RETRYABLE_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(self.retry_delay(e, attempt))
+        if self.token_budget is not None and response.usage is not None:
+            self.token_budget.settle(estimated, response.usage.total_tokens)
+        result = response.choices[0].message.content
+        messages.append(self.create_ans_message(result))
+        return result, messages
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
+
@@ -1,16 +1,20 @@
 from models.base_model import BaseModel
 from transformers import Qwen2VLForConditionalGeneration, AutoProcessor, Qwen2_5_VLForConditionalGeneration, AutoTokenizer
 from qwen_vl_utils import process_vision_info
+from collections import OrderedDict
+from models.kv_cache import PrefixKVCache
+from models.image_budget import ImageBudget
+from models.response_cache import image_ref
 import torch
 
 class Qwen2VL(BaseModel):
     def __init__(self, config):
         super().__init__(config)
-        max_pixels = 2048*28*28
         self.model = Qwen2VLForConditionalGeneration.from_pretrained(
             self.config.model_id, torch_dtype="auto", device_map="balanced_low_0"
         )
-        self.processor = AutoProcessor.from_pretrained(self.config.model_id) # , max_pixels=max_pixels
+        self.processor = AutoProcessor.from_pretrained(self.config.model_id, **self.pixel_kwargs())
+        self.setup_cache()
         self.create_ask_message = lambda question: {
             "role": "user",
             "content": [
@@ -46,13 +50,96 @@ class Qwen2VL(BaseModel):
         }
         return message
     
+    def pixel_kwargs(self):
+        return {
+            key: getattr(self.config, key) for key in ("min_pixels", "max_pixels")
+            if getattr(self.config, key, None) is not None
+        }
+
+    def setup_cache(self):
+        # kv_cache_size > 0 keeps the prefill of recent conversations so a follow-up turn
+        # (e.g. the general agent's self-reflection) only prefills the new tokens
+        self.prefix_cache = None
+        if getattr(self.config, "kv_cache_size", 0) > 0:
+            self.prefix_cache = PrefixKVCache(max_entries=self.config.kv_cache_size)
+        self.pinned_prefixes = set()
+        self.image_budget = ImageBudget.from_config(self.config)
+        # image refs of a conversation -> image_grid_thw, enough to tokenize it again without the image processor
+        self.image_grids = OrderedDict()
+
+    @torch.no_grad()
+    def cache_prefix(self, messages):
+        text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+        if text in self.pinned_prefixes:
+            return
+        if self.prefix_cache is None:
+            self.prefix_cache = PrefixKVCache(max_entries=getattr(self.config, "kv_cache_size", 0))
+        inputs = self.processor.tokenizer([text], return_tensors="pt").to(self.model.device)
+        outputs = self.model(**inputs, use_cache=True)
+        self.prefix_cache.store(inputs["input_ids"][0], outputs.past_key_values, pinned=True)
+        self.pinned_prefixes.add(text)
+
     @torch.no_grad()
-    def predict(self, question, texts = None, images = None, history = None):
-        self.clean_up()
+    def predict(self, question, texts = None, images = None, history = None, image_budget = None, max_new_tokens = None, temperature = None):
+        max_new_tokens, _ = self.generation_settings(max_new_tokens, temperature)
         messages = self.process_message(question, texts, images, history)
-        text = self.processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
+        self.apply_image_budget(messages, image_budget)
+        tokens = self.fit_memory(messages)
+        with self.memory.track(tokens):
+            text = self.processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            if self.prefix_cache is not None:
+                output_text = self.generate_with_cache(messages, text, max_new_tokens)
+            else:
+                output_text = self.generate_batch([messages], max_new_tokens)[0]
+        messages.append(self.create_ans_message(output_text))
+        return output_text, messages
+
+    def apply_image_budget(self, messages, image_budget = None):
+        """Set the resolution of the pages added in the last turn; image_budget overrides the model's own (e.g. per agent)."""
+        image_budget = image_budget or self.image_budget
+        if image_budget is None or not isinstance(messages[-1]["content"], list):
+            return
+        new_images = [content for content in messages[-1]["content"] if content.get("type") == "image"]
+        for content, max_pixels in zip(new_images, image_budget.allocate(len(new_images))):
+            if max_pixels is not None:
+                content["max_pixels"] = max_pixels
+            if image_budget.min_pixels is not None:
+                content["min_pixels"] = image_budget.min_pixels
+
+    def fit_memory(self, messages):
+        """Estimate the input tokens of a conversation; with an explicit memory budget, lower the resolution of its new pages if it would not fit."""
+        tokens = self.memory.estimate_tokens(history=messages)
+        if not self.memory.enabled or self.memory.fits(tokens) or not isinstance(messages[-1]["content"], list):
+            return tokens
+        new_images = [content for content in messages[-1]["content"] if content.get("type") == "image"]
+        if not new_images:
+            return tokens
+        other_tokens = tokens - self.memory.estimate_tokens(history=[{"role": "user", "content": new_images}])
+        max_pixels = self.memory.fit_pixels([content["image"] for content in new_images], other_tokens)
+        if max_pixels is None:
+            return tokens
+        for content in new_images:
+            content["max_pixels"] = min(content.get("max_pixels", max_pixels), max_pixels)
+            # Marks the answer as not reproducible at the configured resolution, see ResponseCache.put
+            content["memory_downscaled"] = True
+        self.memory.downscales += 1
+        print(f"[WARNING] Memory budget: {len(new_images)} pages downscaled to max_pixels={max_pixels} ({tokens} estimated tokens).")
+        return self.memory.estimate_tokens(history=messages)
+
+    def image_refs(self, messages):
+        return tuple(
+            (content["image"], content.get("min_pixels"), content.get("max_pixels")) for message in messages if isinstance(message["content"], list)
+            for content in message["content"] if content.get("type") == "image"
         )
+
+    def cached_images(self, messages, input_ids, image_grid_thw):
+        """(ref, start, end) of every image for the prefix cache; the ref is the page's content hash and pixel limits."""
+        refs = [(image_ref(image), min_pixels, max_pixels) for image, min_pixels, max_pixels in self.image_refs(messages)]
+        return [(ref, start, end) for ref, (start, end) in zip(refs, self.image_spans(input_ids, image_grid_thw))]
+
+    def process_inputs(self, messages, text):
         image_inputs, video_inputs = process_vision_info(messages)
         inputs = self.processor(
             text=[text],
@@ -61,18 +148,166 @@ class Qwen2VL(BaseModel):
             padding=True,
             return_tensors="pt",
         )
+        refs = self.image_refs(messages)
+        if refs and video_inputs is None:
+            self.image_grids[refs] = inputs["image_grid_thw"]
+            while len(self.image_grids) > 64:
+                self.image_grids.popitem(last=False)
+        return inputs
+
+    def tokenize_with_grids(self, text, image_grid_thw):
+        """Tokenize a prompt whose images were processed before, expanding image pads like the processor does."""
+        parts = text.split("<|image_pad|>")
+        if len(parts) - 1 != (0 if image_grid_thw is None else len(image_grid_thw)) or "<|video_pad|>" in text:
+            return None
+        merge_length = self.processor.image_processor.merge_size ** 2
+        expanded = parts[0]
+        for grid, part in zip(image_grid_thw if image_grid_thw is not None else [], parts[1:]):
+            expanded += "<|image_pad|>" * int(grid.prod() // merge_length) + part
+        inputs = self.processor.tokenizer([expanded], return_tensors="pt")
+        if image_grid_thw is not None:
+            inputs["image_grid_thw"] = image_grid_thw
+        return inputs
+
+    def image_spans(self, input_ids, image_grid_thw):
+        """(start, end) token span of every image in a 1-D input_ids."""
+        if image_grid_thw is None:
+            return []
+        positions = (input_ids == self.model.config.image_token_id).nonzero().flatten().tolist()
+        merge_length = self.processor.image_processor.merge_size ** 2
+        spans, offset = [], 0
+        for grid in image_grid_thw:
+            n_tokens = int(grid.prod() // merge_length)
+            spans.append((positions[offset], positions[offset + n_tokens - 1] + 1))
+            offset += n_tokens
+        return spans
+
+    def rope_index(self, input_ids, image_grid_thw, attention_mask):
+        get_rope_index = getattr(self.model, "get_rope_index", None) or self.model.model.get_rope_index
+        return get_rope_index(input_ids=input_ids, image_grid_thw=image_grid_thw, attention_mask=attention_mask)
+
+    def set_rope_deltas(self, rope_deltas):
+        for module in (self.model, getattr(self.model, "model", None)):
+            if module is not None and hasattr(module, "rope_deltas"):
+                module.rope_deltas = rope_deltas
+
+    def generate_with_cache(self, messages, text, max_new_tokens):
+        refs = self.image_refs(messages)
+        inputs = None
+        if not refs or refs in self.image_grids:
+            inputs = self.tokenize_with_grids(text, self.image_grids.get(refs))
+        if inputs is None:
+            inputs = self.process_inputs(messages, text)
+        input_ids = inputs["input_ids"]
+        images = self.cached_images(messages, input_ids[0], inputs.get("image_grid_thw"))
+
+        past_key_values, _, prefix_len = self.prefix_cache.lookup(input_ids[0], images)
+        if past_key_values is None:
+            if "pixel_values" not in inputs and refs:
+                inputs = self.process_inputs(messages, text)
+            inputs = inputs.to("cuda")
+            outputs = self.model.generate(
+                **inputs, max_new_tokens=max_new_tokens, return_dict_in_generate=True
+            )
+        else:
+            # Images are either fully inside the reused prefix or fully re-encoded
+            image_grid_thw = inputs.get("image_grid_thw")
+            spans = self.image_spans(input_ids[0], image_grid_thw)
+            first_new_image = len(spans)
+            for index, (start, end) in enumerate(spans):
+                if end > prefix_len:
+                    first_new_image = index
+                    prefix_len = min(prefix_len, start)
+                    break
+            past_key_values.crop(prefix_len)
+            pixel_values = None
+            if first_new_image < len(spans):
+                if "pixel_values" not in inputs:
+                    inputs["pixel_values"] = self.process_inputs(messages, text)["pixel_values"]
+                patch_offset = int(image_grid_thw[:first_new_image].prod(dim=-1).sum())
+                pixel_values = inputs["pixel_values"][patch_offset:].to("cuda")
+                new_image_grid_thw = image_grid_thw[first_new_image:].to("cuda")
+
+            input_ids = input_ids.to("cuda")
+            attention_mask = inputs["attention_mask"].to("cuda")
+            position_ids, rope_deltas = self.rope_index(
+                input_ids, image_grid_thw.to("cuda") if image_grid_thw is not None else None, attention_mask
+            )
+            # Prefill everything after the reused prefix but the last token, generate() feeds that one
+            end = input_ids.shape[1] - 1
+            if end > prefix_len:
+                self.model(
+                    input_ids=input_ids[:, prefix_len:end],
+                    attention_mask=attention_mask[:, :end],
+                    position_ids=position_ids[:, :, prefix_len:end],
+                    pixel_values=pixel_values,
+                    image_grid_thw=new_image_grid_thw if pixel_values is not None else None,
+                    past_key_values=past_key_values,
+                    cache_position=torch.arange(prefix_len, end, device=input_ids.device),
+                    use_cache=True,
+                )
+            self.set_rope_deltas(rope_deltas)
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                return_dict_in_generate=True,
+            )
+
+        sequences = outputs.sequences
+        self.prefix_cache.store(sequences[0], outputs.past_key_values, extra={"images": images})
+        return self.processor.batch_decode(
+            sequences[:, input_ids.shape[1]:], skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )[0]
+
+    @torch.no_grad()
+    def predict_batch(self, questions, texts_list = None, images_list = None, histories = None, image_budget = None, max_new_tokens = None, temperature = None):
+        max_new_tokens, _ = self.generation_settings(max_new_tokens, temperature)
+        n = len(questions)
+        texts_list = texts_list or [None] * n
+        images_list = images_list or [None] * n
+        histories = histories or [None] * n
+        messages_list = [
+            self.process_message(question, texts, images, history)
+            for question, texts, images, history in zip(questions, texts_list, images_list, histories)
+        ]
+        for messages in messages_list:
+            self.apply_image_budget(messages, image_budget)
+        token_counts = [self.fit_memory(messages) for messages in messages_list]
+        output_texts = []
+        # Generate as many conversations together as the memory budget allows
+        for batch in self.memory.plan_batches(token_counts):
+            with self.memory.track(sum(token_counts[i] for i in batch)):
+                output_texts += self.generate_batch([messages_list[i] for i in batch], max_new_tokens)
+        for messages, output_text in zip(messages_list, output_texts):
+            messages.append(self.create_ans_message(output_text))
+        return output_texts, messages_list
+
+    def generate_batch(self, messages_list, max_new_tokens):
+        text = [
+            self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            for messages in messages_list
+        ]
+        image_inputs, video_inputs = process_vision_info(messages_list)
+        # Left padding keeps every prompt flush against its generated tokens
+        self.processor.tokenizer.padding_side = "left"
+        inputs = self.processor(
+            text=text,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt",
+        )
         inputs = inputs.to("cuda")
 
-        generated_ids = self.model.generate(**inputs, max_new_tokens=self.config.max_new_tokens)
+        generated_ids = self.model.generate(**inputs, max_new_tokens=max_new_tokens)
         generated_ids_trimmed = [
             out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
         ]
-        output_text = self.processor.batch_decode(
+        return self.processor.batch_decode(
             generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0]
-        messages.append(self.create_ans_message(output_text))
-        self.clean_up()
-        return output_text, messages
+        )
         
     def is_valid_history(self, history):
         if not isinstance(history, list):
@@ -95,11 +330,12 @@ class Qwen2VL(BaseModel):
 
 class Qwen2_5VL(Qwen2VL):
     def __init__(self, config):
-        self.config = config
+        BaseModel.__init__(self, config)
         self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
             self.config.model_id, torch_dtype="auto", device_map="balanced_low_0"
         )
-        self.processor = AutoProcessor.from_pretrained(self.config.model_id)
+        self.processor = AutoProcessor.from_pretrained(self.config.model_id, **self.pixel_kwargs())
+        self.setup_cache()
         self.create_ask_message = lambda question: {
             "role": "user",
             "content": [
@@ -0,0 +1,106 @@
+import gc
+import importlib
+import threading
+import time
+import torch
+
+
+def model_key(config):
+    """Models with the same key share one instance: same weights, dtype and device.
+
+    Per-agent generation settings and page limits are passed with each call (Agent.model_kwargs);
+    instance settings such as kv_cache_size come from the config that loads the model first.
+    """
+    return (
+        config.module_name,
+        config.class_name,
+        getattr(config, "model_id", None) or getattr(config, "model", None),
+        getattr(config, "torch_dtype", None),
+        getattr(config, "device", None),
+    )
+
+
+class LazyModel():
+    """Stand-in for a model that is only loaded on first use.
+
+    Attribute access (e.g. ``predict``) is forwarded to the real model, loading it
+    first if needed, so agents can hold a LazyModel wherever they held a model.
+    """
+    def __init__(self, key, config):
+        self._key = key
+        self._config = config
+        self._model = None
+        self._lock = threading.Lock()
+        self.refs = 0
+        self.last_used = time.time()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    module = importlib.import_module(self._config.module_name)
+                    model_class = getattr(module, self._config.class_name)
+                    print("Create model: ", self._config.class_name, self._key[2])
+                    self._model = model_class(self._config)
+        self.last_used = time.time()
+        return self._model
+
+    def unload(self):
+        with self._lock:
+            if self._model is None:
+                return
+            print("Unload model: ", self._config.class_name, self._key[2])
+            self._model = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def __getattr__(self, name):
+        # Only reached for attributes the proxy itself does not have
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+class ModelRegistry():
+    """Process-wide table of models keyed by model_key."""
+    def __init__(self):
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, config):
+        """Get the (lazy) model for config and count the caller as a user."""
+        key = model_key(config)
+        with self._lock:
+            if key not in self.models:
+                self.models[key] = LazyModel(key, config)
+            model = self.models[key]
+            model.refs += 1
+        return model
+
+    def release(self, model):
+        """Drop one user; a model nobody uses any more is unloaded."""
+        with self._lock:
+            model.refs -= 1
+            unused = model.refs <= 0
+            if unused:
+                self.models.pop(model._key, None)
+        if unused:
+            model.unload()
+
+    def unload_idle(self, idle_seconds):
+        """Unload models not used for idle_seconds; they are loaded again on their next use."""
+        now = time.time()
+        for model in list(self.models.values()):
+            if model.loaded and now - model.last_used > idle_seconds:
+                model.unload()
+
+    def loaded_models(self):
+        return [model for model in self.models.values() if model.loaded]
+
+
+registry = ModelRegistry()
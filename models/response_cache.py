@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import threading
+from mydatasets.kv_store import DiskKVStore
+
+# One store per file, shared by every agent and model of the process
+_stores = {}
+_stores_lock = threading.Lock()
+_file_digests = {}
+
+
+def open_store(path, max_mb=None):
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = DiskKVStore(path, max_bytes=max_mb * 1024 * 1024 if max_mb else None)
+        return _stores[path]
+
+
+def open_stores():
+    return dict(_stores)
+
+
+def file_digest(path):
+    """sha1 of a file's bytes, remembered per (path, mtime, size)."""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _file_digests:
+        with open(path, "rb") as f:
+            _file_digests[key] = hashlib.sha1(f.read()).hexdigest()
+    return _file_digests[key]
+
+
+def image_ref(image):
+    # Pages are keyed by their content, so re-rendered or moved files still hit
+    if isinstance(image, str) and os.path.isfile(image):
+        return file_digest(image)
+    return image
+
+
+def hashable_messages(messages):
+    refs = []
+    for message in messages or []:
+        content = message["content"]
+        if isinstance(content, list):
+            content = [
+                {**item, "image": image_ref(item["image"])} if "image" in item else item
+                for item in content
+            ]
+        refs.append({**message, "content": content})
+    return refs
+
+
+class ResponseCache():
+    """Persistent cache of model answers keyed by everything that determines them.
+
+    The key covers the model (module, class, model_id), its generation settings, the
+    question, texts, image file contents and the full history, so any change in a prompt
+    or an upstream answer is a miss. Only deterministic configs (temperature 0) are cached.
+    """
+    def __init__(self, store, model_config):
+        self.store = store
+        self.model_fields = {
+            "module_name": model_config.module_name,
+            "class_name": model_config.class_name,
+            "model_id": getattr(model_config, "model_id", None) or getattr(model_config, "model", None),
+            "max_new_tokens": getattr(model_config, "max_new_tokens", None),
+            "temperature": getattr(model_config, "temperature", None),
+        }
+
+    @classmethod
+    def from_config(cls, model_config):
+        path = getattr(model_config, "response_cache", None)
+        if not path or (getattr(model_config, "temperature", 0) or 0) > 0:
+            return None
+        return cls(open_store(path, getattr(model_config, "response_cache_size_mb", None)), model_config)
+
+    def key(self, question, texts=None, images=None, history=None, model_kwargs=None):
+        payload = {
+            "model": self.model_fields,
+            "kwargs": {name: getattr(value, "__dict__", value) for name, value in (model_kwargs or {}).items()},
+            "question": question,
+            "texts": texts,
+            "images": [image_ref(image) for image in images or []],
+            "history": hashable_messages(history),
+        }
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """(answer, messages) stored for key, or None."""
+        value = self.store.get_json(key)
+        return None if value is None else (value["answer"], value["messages"])
+
+    def put(self, key, answer, messages):
+        # Pages shrunk to fit the memory budget give answers the key does not describe
+        if any(
+            isinstance(message["content"], list) and any(content.get("memory_downscaled") for content in message["content"])
+            for message in messages
+        ):
+            return
+        self.store.put_json(key, {"answer": answer, "messages": messages})
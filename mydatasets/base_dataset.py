@@ -1,3 +1,4 @@
+import hashlib
 import json
 import re
 from dataclasses import dataclass
@@ -7,8 +8,14 @@ import pymupdf
 from tqdm import tqdm
 from datetime import datetime
 import glob
+from collections import Counter, OrderedDict
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Dict, List  # 类型提示
 from hydra.utils import to_absolute_path
+from mydatasets.packed_text import PackedTextStore
+from mydatasets.page_renderer import PageRenderer
+from mydatasets.jsonl_store import JsonlWriter, iter_jsonl
 @dataclass
 class Content:
     image: Image            # 当前页的图像对象
@@ -16,6 +23,40 @@ class Content:
     txt: str                # 当前页的文字内容
 
 
+class LazyContent(Content):
+    """Content whose page text is only read from disk on first access.
+
+    With ``image_path_loader`` the page image is rendered on demand and
+    ``image_path`` makes sure the file exists every time it is read; with
+    ``image_loader`` the image is produced on access and never kept.
+    """
+    def __init__(self, image, image_path, txt_loader, image_path_loader=None, image_loader=None):
+        self._image = image
+        self._image_path = image_path
+        self._image_path_loader = image_path_loader
+        self._image_loader = image_loader
+        self._txt_loader = txt_loader
+        self._txt = None
+
+    @property
+    def image(self):
+        if self._image is None and self._image_loader is not None:
+            return self._image_loader()
+        return self._image
+
+    @property
+    def image_path(self):
+        if self._image_path_loader is not None:
+            return self._image_path_loader()
+        return self._image_path
+
+    @property
+    def txt(self):
+        if self._txt is None:
+            self._txt = self._txt_loader()
+        return self._txt
+
+
 class BaseDataset():
     def __init__(self, config):
         self.config = config  # 配置加载
@@ -39,11 +80,30 @@ class BaseDataset():
         self.TEXT_FILE = (
             lambda doc_name, index: f"{self.config.extract_path}/{doc_name}_{index}.txt"
         )  # 按页存路径（也是论文中的说法：对文字按页再按段落）
+        # <extract_path>/<doc_id>.manifest.json，记录页数、每页文件和文本偏移
+        self.MANIFEST_FILE = (
+            lambda doc_name: f"{self.config.extract_path}/{doc_name}.manifest.json"
+        )
         self.EXTRACT_DOCUMENT_ID = lambda sample: re.sub(
             "\\.pdf$", "", sample["doc_id"]
         ).split("/")[-1]
         current_time = datetime.now()
         self.time = current_time.strftime("%Y-%m-%d-%H-%M")  # 时间戳用于保存输出结果
+        # 按 doc_id 缓存解析好的 Content 列表（LRU），同一文档的多个问题不再重复读盘
+        self._content_cache = OrderedDict()
+        self.content_cache_size = getattr(self.config, "content_cache_size", 32)
+        # text_store: files（每页一个 .txt）或 packed（整个数据集打包成一个 mmap 文件）
+        self.text_store = None
+        # image_mode: eager（抽取时渲染所有页）或 lazy（第一次访问时才渲染，并限制磁盘缓存大小）
+        self.lazy_images = getattr(self.config, "image_mode", "eager") == "lazy"
+        self.renderer = None
+        if self.lazy_images:
+            cache_mb = getattr(self.config, "image_cache_size_mb", None)
+            self.renderer = PageRenderer(
+                self.config.extract_path,
+                resolution=getattr(self.config, "resolution", 144),
+                max_cache_bytes=cache_mb * 1024 * 1024 if cache_mb else None,
+            )
 
     # 数据加载
     def load_data(self, use_retreival=True):
@@ -94,6 +154,29 @@ class BaseDataset():
             json.dump(samples, f, indent = 4)
         return path
 
+    # 追加式结果日志：每完成一个 sample 追加一行 {"_index": i, <新字段>}
+    def results_log_path(self):
+        return os.path.join(self.config.result_dir, self.time + ".jsonl")
+
+    def open_results_log(self, path=None):
+        return JsonlWriter(path or self.results_log_path())
+
+    def merge_results_log(self, samples, path):
+        done = set()
+        for record in iter_jsonl(path):
+            index = record.pop("_index")
+            if index < len(samples):
+                samples[index].update(record)
+                done.add(index)
+        return done
+
+    # 把结果日志合并回样本，输出旧格式的 <时间戳>.json，供 eval_dataset 使用
+    def compact_results(self, path, samples=None):
+        if samples is None:
+            samples = self.load_data(use_retreival=True)
+        self.merge_results_log(samples, path)
+        return self.dump_reults(samples)
+
     # 加载带检索字段（r_text/r_image）的数据，并提取相应文本图像路径
     def load_retrieval_data(self):
         if not os.path.exists(self.config.sample_with_retrieval_path):
@@ -113,12 +196,14 @@ class BaseDataset():
         images = []
         if self.config.use_mix:
             if self.config.r_mix_key in sample:
+                image_pages = set(sample.get(self.config.r_image_key, []))
+                text_pages = set(sample.get(self.config.r_text_key, []))
                 for page in sample[self.config.r_mix_key][:self.config.top_k]:
-                    if page in sample[self.config.r_image_key]:
+                    if page in image_pages:
                         origin_image_path = ""
                         origin_image_path = content_list[page].image_path
                         images.append(origin_image_path)
-                    if page in sample[self.config.r_text_key]:
+                    if page in text_pages:
                         texts.append(content_list[page].txt.replace("\n", ""))
         else:
             if self.config.r_text_key in sample:
@@ -131,6 +216,12 @@ class BaseDataset():
                     images.append(origin_image_path)
 
         return question, texts, images
+    # 单个 sample 的检索分数（与 load_sample_retrieval_data 使用的 top_k 页面对应）
+    def load_sample_retrieval_scores(self, sample):
+        return {
+            "text": sample.get(self.config.r_text_key+"_score", [])[:self.config.top_k],
+            "image": sample.get(self.config.r_image_key+"_score", [])[:self.config.top_k],
+        }
     # 加载整个文档的所有页面内容（非检索）
     def load_full_data(self):
         samples = self.load_data(use_retreival=False)
@@ -155,21 +246,113 @@ class BaseDataset():
             images.append(origin_image_path)
 
         return question, texts, images
-    # 从 .txt 和 .png 文件中加载结构化内容
+    # 从 .txt 和 .png 文件中加载结构化内容，文本在第一次访问时才读取
     def load_processed_content(self, sample: Dict, disable_load_image=True) -> List[Content]:
         doc_name = self.EXTRACT_DOCUMENT_ID(sample)
+        if doc_name in self._content_cache:
+            self._content_cache.move_to_end(doc_name)
+            content_list = self._content_cache[doc_name]
+        else:
+            content_list = self._load_document_pages(doc_name, sample["doc_id"])
+            if content_list:
+                self._content_cache[doc_name] = content_list
+                if len(self._content_cache) > self.content_cache_size:
+                    self._content_cache.popitem(last=False)
+        if disable_load_image:
+            return content_list
+        # 图像不进缓存，避免常驻内存；lazy 模式下直接用内存中的 pixmap，不经过 PNG 编解码
+        if self.lazy_images:
+            pdf_path = os.path.join(self.config.document_path, sample["doc_id"])
+            return [
+                # 传入未渲染的路径和 loader，只有真正读取 image_path 时才写 PNG
+                LazyContent(image=None, image_path=content._image_path,
+                            txt_loader=partial(getattr, content, "txt"),
+                            image_path_loader=content._image_path_loader,
+                            image_loader=partial(self.renderer.render_image, pdf_path, index))
+                for index, content in enumerate(content_list)
+            ]
+        return [
+            LazyContent(image=self.load_image(content.image_path), image_path=content.image_path,
+                        txt_loader=partial(getattr, content, "txt"))
+            for content in content_list
+        ]
+
+    def _load_document_pages(self, doc_name, doc_id=None) -> List[Content]:
+        manifest = self.load_manifest(doc_name)
+        if manifest is None:
+            # 旧的抽取结果没有 manifest：逐页探测一次，然后补写 manifest
+            page_count = 0
+            while page_count < self.config.max_page and self._page_exists(doc_name, page_count):
+                page_count += 1
+            if page_count == 0:
+                return []
+            manifest = self._write_manifest(doc_name, page_count, doc_id=doc_id)
+        pdf_path = os.path.join(self.config.document_path, manifest.get("doc_id") or doc_id or "")
         content_list = []
-        for page_idx in range(self.config.max_page):
-            im_file = self.IM_FILE(doc_name, page_idx)
-            text_file = self.TEXT_FILE(doc_name, page_idx)
-            if not os.path.exists(im_file):
-                break
-            img = None
-            if not disable_load_image:
-                img = self.load_image(im_file)
-            txt = self.load_txt(text_file)
-            content_list.append(Content(image=img, image_path=im_file, txt=txt))
-        return content_list
+        for index, (image_name, text_name) in enumerate(zip(manifest["images"], manifest["texts"])):
+            im_file = os.path.join(self.config.extract_path, image_name)
+            text_file = os.path.join(self.config.extract_path, text_name)
+            image_path_loader = None
+            if self.lazy_images:
+                image_path_loader = partial(self.renderer.render_file, pdf_path, index, im_file)
+            content_list.append(LazyContent(image=None, image_path=im_file,
+                                            txt_loader=partial(self.load_txt, text_file),
+                                            image_path_loader=image_path_loader))
+        return content_list[:self.config.max_page]
+
+    def _page_exists(self, doc_name, index):
+        # lazy 模式下图片可能尚未渲染，以文本是否存在为准
+        if self.lazy_images:
+            text_file = self.TEXT_FILE(doc_name, index)
+            return os.path.exists(text_file) or self.is_packed(text_file)
+        return os.path.exists(self.IM_FILE(doc_name, index))
+
+    # 文档抽取结果的指纹（manifest + 每页文本内容），只随内容变化，用于让检索缓存失效
+    def document_fingerprint(self, sample):
+        doc_name = self.EXTRACT_DOCUMENT_ID(sample)
+        manifest_file = self.MANIFEST_FILE(doc_name)
+        if not os.path.exists(manifest_file):
+            # 旧的抽取结果会在加载时补写 manifest
+            self.load_processed_content(sample)
+            if not os.path.exists(manifest_file):
+                return None
+        with open(manifest_file, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data)
+        manifest = json.loads(data)
+        for text_name in manifest["texts"]:
+            text_file = os.path.join(self.config.extract_path, text_name)
+            if os.path.exists(text_file) or self.is_packed(text_file):
+                digest.update(self.load_txt(text_file).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def load_manifest(self, doc_name):
+        manifest_file = self.MANIFEST_FILE(doc_name)
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+
+    def _write_manifest(self, doc_name, page_count, doc_id=None):
+        images = [os.path.basename(self.IM_FILE(doc_name, index)) for index in range(page_count)]
+        texts = [os.path.basename(self.TEXT_FILE(doc_name, index)) for index in range(page_count)]
+        manifest = {
+            "doc_id": doc_id,
+            "page_count": page_count,
+            "images": images,
+            "texts": texts,
+        }
+        # 内容未变时不重写，重复抽取不会改动已有 manifest
+        if self.load_manifest(doc_name) == manifest:
+            return manifest
+        manifest_file = self.MANIFEST_FILE(doc_name)
+        with open(manifest_file + ".tmp", 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_file + ".tmp", manifest_file)
+        self._content_cache.pop(doc_name, None)
+        return manifest
+
     # 加载图像 / 文本文件内容
     def load_image(self, file):
         pil_im = Image.open(file)
@@ -177,15 +360,51 @@ class BaseDataset():
 
     def load_txt(self, file):
         max_length = self.config.max_character_per_page
-        with open(file, 'r') as file:
-            content = file.read()
+        if self.is_packed(file):
+            content = self.text_store.read(os.path.basename(file))
+        else:
+            with open(file, 'r') as file:
+                content = file.read()
         content = content.replace('\r\n', ' ').replace('\r', ' ').replace('\n', ' ')
         return content[:max_length]
+    def get_text_store(self):
+        if getattr(self.config, "text_store", "files") != "packed":
+            return None
+        if self.text_store is None and PackedTextStore.exists(self.config.extract_path):
+            self.text_store = PackedTextStore(self.config.extract_path)
+        return self.text_store
+
+    def is_packed(self, text_file):
+        store = self.get_text_store()
+        return store is not None and os.path.basename(text_file) in store
+
+    # 把已有的逐页 .txt 打包进 packed 存储（可选删除原文件）
+    def pack_texts(self, remove_source=False):
+        if self.text_store is None:
+            self.text_store = PackedTextStore(self.config.extract_path)
+        path = self.text_store.pack(remove_source=remove_source)
+        print(f"Packed {len(self.text_store)} pages into {path}.")
+        return path
+
     # 提取 PDF 内容为图像和文本（写入磁盘）
     def extract_content(self, resolution=144):
         samples = self.load_data()
-        for sample in tqdm(samples):
-            self._extract_content(sample, resolution=resolution)
+        # 多个 sample 共享同一个 doc_id，先去重，每个文档只处理一次
+        documents = self.unique_documents(samples)
+        num_workers = getattr(self.config, "extract_workers", 1) or 1
+        if num_workers <= 1:
+            for sample in tqdm(documents):
+                self._extract_content(sample, resolution=resolution)
+        else:
+            self._parallel_extract_content(documents, num_workers, resolution=resolution)
+        if getattr(self.config, "text_store", "files") == "packed":
+            self.pack_texts(remove_source=getattr(self.config, "remove_packed_texts", False))
+
+    def unique_documents(self, samples):
+        documents = {}
+        for sample in samples:
+            documents.setdefault(self.EXTRACT_DOCUMENT_ID(sample), sample)
+        return list(documents.values())
 
     def _extract_content(self, sample, resolution=144):
         max_pages = self.config.max_page
@@ -204,23 +423,95 @@ class BaseDataset():
                 for index, page in enumerate(pdf[:max_pages]):
                     # 保存图像
                     im_file = self.IM_FILE(doc_name, index)
-                    if not os.path.exists(im_file):
+                    if not self.lazy_images and not os.path.exists(im_file):
                         im = page.get_pixmap(dpi=resolution)
                         im.save(im_file)
                     image_list.append(im_file)
 
                     # 保存文本
                     txt_file = self.TEXT_FILE(doc_name, index)
-                    if not os.path.exists(txt_file):
+                    if not os.path.exists(txt_file) and not self.is_packed(txt_file):
                         text = page.get_text("text")
                         with open(txt_file, 'w') as f:
                             f.write(text)
                     text_list.append(txt_file)
 
+            self._write_manifest(doc_name, len(image_list), doc_id=sample["doc_id"])
         except Exception as e:
             print(f"[错误] 处理文件失败: {pdf_path}, 错误信息: {e}")
 
         return image_list, text_list
+
+    # 多进程提取：pymupdf 的文档对象不能跨线程共享，所以按页段拆分任务，每个进程自己打开 PDF
+    def _parallel_extract_content(self, samples, num_workers, resolution=144):
+        max_pages = self.config.max_page
+        chunk_size = getattr(self.config, "extract_chunk_size", 16)
+        os.makedirs(self.config.extract_path, exist_ok=True)
+
+        futures = {}
+        documents = {}
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for sample in samples:
+                doc_name = self.EXTRACT_DOCUMENT_ID(sample)
+                pdf_path = os.path.join(self.config.document_path, sample["doc_id"])
+                if not os.path.exists(pdf_path):
+                    print(f"[跳过] 找不到文件: {pdf_path}")
+                    continue
+                try:
+                    with pymupdf.open(pdf_path) as pdf:
+                        page_count = min(len(pdf), max_pages)
+                except Exception as e:
+                    print(f"[错误] 处理文件失败: {pdf_path}, 错误信息: {e}")
+                    continue
+
+                documents[doc_name] = (sample["doc_id"], page_count)
+                for start in range(0, page_count, chunk_size):
+                    pages = []
+                    for index in range(start, min(start + chunk_size, page_count)):
+                        txt_file = self.TEXT_FILE(doc_name, index)
+                        if self.is_packed(txt_file):
+                            txt_file = None
+                        im_file = None if self.lazy_images else self.IM_FILE(doc_name, index)
+                        pages.append((index, im_file, txt_file))
+                    future = executor.submit(extract_pages, pdf_path, pages, resolution)
+                    futures[future] = doc_name
+
+            # 按文档汇报进度：一个文档的所有页段都完成后才计为完成
+            pending = Counter(futures.values())
+            failed = set()
+            with tqdm(total=len(pending)) as pbar:
+                for future in as_completed(futures):
+                    doc_name = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed.add(doc_name)
+                        print(f"[错误] 处理文件失败: {doc_name}, 错误信息: {e}")
+                    pending[doc_name] -= 1
+                    if pending[doc_name] == 0:
+                        if doc_name not in failed:
+                            doc_id, page_count = documents[doc_name]
+                            self._write_manifest(doc_name, page_count, doc_id=doc_id)
+                        pbar.set_postfix_str(doc_name)
+                        pbar.update(1)
+
+def extract_pages(pdf_path, pages, resolution=144):
+    """Render and dump a slice of pages of one PDF, in a worker process.
+
+    Writes exactly what ``BaseDataset._extract_content`` writes for the same
+    pages, so serial and parallel extraction produce identical files.
+    """
+    with pymupdf.open(pdf_path) as pdf:
+        for index, im_file, txt_file in pages:
+            page = pdf[index]
+            if im_file is not None and not os.path.exists(im_file):
+                im = page.get_pixmap(dpi=resolution)
+                im.save(im_file)
+            if txt_file is not None and not os.path.exists(txt_file):
+                text = page.get_text("text")
+                with open(txt_file, 'w') as f:
+                    f.write(text)
+
 def extract_time(file_path):
     file_name = os.path.basename(file_path)
     time_str = file_name.split(".json")[0]
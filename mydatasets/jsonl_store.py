@@ -0,0 +1,66 @@
+import json
+import os
+
+
+def truncate_partial_line(path, chunk_size=65536):
+    """Cut a file back to just after its last newline, dropping a record left half-written by a crash."""
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            f.truncate(position)
+
+
+class JsonlWriter():
+    """Append-only JSON Lines writer; every record is flushed as soon as it is written.
+
+    Reopening a log whose last line was cut off by a crash first drops that partial line,
+    so new records never get glued onto it.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            truncate_partial_line(path)
+        self.file = open(path, "a")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def iter_jsonl(path):
+    """Yield records of a JSON Lines file.
+
+    A run killed mid-write can leave a partial last line; it is skipped so the
+    log can still be resumed from.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skip truncated record in {path}.")
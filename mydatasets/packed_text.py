@@ -0,0 +1,99 @@
+import glob
+import json
+import mmap
+import os
+
+
+class PackedTextStore():
+    """Page texts of a whole dataset packed into one file plus an offset index.
+
+    Pages are addressed by the name of the per-page text file they replace
+    (``<doc_id>_<page_index>.txt``), so callers can keep using the paths from
+    ``BaseDataset.TEXT_FILE``. The data file is opened with ``mmap`` and pages
+    are decoded straight from the mapped buffer.
+    """
+    DATA_FILE = "pages.txt.bin"
+    INDEX_FILE = "pages.index.json"
+
+    def __init__(self, root):
+        self.root = root
+        self.data_path = os.path.join(root, self.DATA_FILE)
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self.index = {}
+        self._file = None
+        self._mmap = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+
+    @classmethod
+    def exists(cls, root):
+        return os.path.exists(os.path.join(root, cls.INDEX_FILE))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _buffer(self):
+        if self._mmap is None:
+            self._file = open(self.data_path, "rb")
+            if os.fstat(self._file.fileno()).st_size == 0:
+                # mmap 不能映射空文件
+                self._mmap = b""
+            else:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def read_bytes(self, name):
+        offset, length = self.index[name]
+        return memoryview(self._buffer())[offset:offset + length]
+
+    def read(self, name):
+        view = self.read_bytes(name)
+        try:
+            return str(view, "utf-8")
+        finally:
+            view.release()
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+        self._mmap = None
+        self._file = None
+
+    def pack(self, remove_source=False):
+        """Pack every ``*.txt`` page under ``root`` (and pages already packed) into the store."""
+        text_files = {
+            os.path.basename(path): path
+            for path in glob.glob(os.path.join(glob.escape(self.root), "*.txt"))
+        }
+        names = sorted(set(self.index) | set(text_files))
+
+        index = {}
+        offset = 0
+        with open(self.data_path + ".tmp", "wb") as out:
+            for name in names:
+                if name in text_files:
+                    # 与 load_txt 一致：按文本模式读入（统一换行符）后再以 utf-8 写出
+                    with open(text_files[name], "r") as f:
+                        data = f.read().encode("utf-8")
+                else:
+                    data = bytes(self.read_bytes(name))
+                out.write(data)
+                index[name] = [offset, len(data)]
+                offset += len(data)
+        self.close()
+        os.replace(self.data_path + ".tmp", self.data_path)
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self.index = index
+
+        if remove_source:
+            for path in text_files.values():
+                os.remove(path)
+        return self.data_path
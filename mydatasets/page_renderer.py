@@ -0,0 +1,145 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pymupdf
+from PIL import Image
+
+
+class PageRenderer():
+    """Renders PDF pages on demand, with a size-bounded PNG cache on disk.
+
+    ``render_file`` produces the same ``<doc_id>_<page_index>.png`` file the
+    eager extraction writes, so downstream code can keep passing image paths
+    around. ``render_image`` skips the PNG encode/decode round trip and returns
+    the pixmap as a PIL image directly. Cached files are evicted oldest-first
+    (by mtime, refreshed on every hit) once ``max_cache_bytes`` is exceeded.
+    Only pages rendered here (listed in ``RENDERED_FILE``) are ever evicted,
+    never ones written by eager extraction, and the last ``protect_recent``
+    paths handed out are kept so pages of the samples in flight stay on disk.
+    """
+    RENDERED_FILE = ".rendered_pages"
+
+    def __init__(self, cache_dir, resolution=144, max_cache_bytes=None, max_open_documents=4, protect_recent=256):
+        self.cache_dir = cache_dir
+        self.resolution = resolution
+        self.max_cache_bytes = max_cache_bytes
+        self.max_open_documents = max_open_documents
+        # pymupdf 的 Document 不是线程安全的，所有访问都在锁内完成
+        self.lock = threading.RLock()
+        self._documents = OrderedDict()
+        self._cache_bytes = None
+        self._rendered = None
+        self._recent = OrderedDict()
+        self.protect_recent = protect_recent
+
+    def _open(self, pdf_path):
+        if pdf_path in self._documents:
+            self._documents.move_to_end(pdf_path)
+            return self._documents[pdf_path]
+        pdf = pymupdf.open(pdf_path)
+        self._documents[pdf_path] = pdf
+        if len(self._documents) > self.max_open_documents:
+            _, oldest = self._documents.popitem(last=False)
+            oldest.close()
+        return pdf
+
+    def render_pixmap(self, pdf_path, index):
+        with self.lock:
+            return self._open(pdf_path)[index].get_pixmap(dpi=self.resolution)
+
+    def render_image(self, pdf_path, index):
+        pix = self.render_pixmap(pdf_path, index)
+        mode = "RGBA" if pix.alpha else "RGB"
+        return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+    def render_file(self, pdf_path, index, im_file):
+        with self.lock:
+            self._protect(im_file)
+            if os.path.exists(im_file):
+                os.utime(im_file)
+                return im_file
+            pix = self.render_pixmap(pdf_path, index)
+            os.makedirs(os.path.dirname(im_file), exist_ok=True)
+            pix.save(im_file + ".tmp.png")
+            os.replace(im_file + ".tmp.png", im_file)
+            self._record(im_file)
+            self._account(os.path.getsize(im_file))
+        return im_file
+
+    def _protect(self, path):
+        self._recent[path] = None
+        self._recent.move_to_end(path)
+        while len(self._recent) > self.protect_recent:
+            self._recent.popitem(last=False)
+
+    def _rendered_files(self):
+        if self._rendered is None:
+            self._rendered = set()
+            manifest = os.path.join(self.cache_dir, self.RENDERED_FILE)
+            if os.path.exists(manifest):
+                with open(manifest, "r") as f:
+                    self._rendered = {os.path.join(self.cache_dir, line.strip()) for line in f if line.strip()}
+        return self._rendered
+
+    def _record(self, path):
+        self._rendered_files().add(path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, self.RENDERED_FILE), "a") as f:
+            f.write(os.path.relpath(path, self.cache_dir) + "\n")
+
+    def _write_rendered(self):
+        manifest = os.path.join(self.cache_dir, self.RENDERED_FILE)
+        with open(manifest + ".tmp", "w") as f:
+            for path in sorted(self._rendered):
+                f.write(os.path.relpath(path, self.cache_dir) + "\n")
+        os.replace(manifest + ".tmp", manifest)
+
+    def _cached_files(self):
+        return [path for path in self._rendered_files() if os.path.exists(path)]
+
+    def _account(self, size):
+        if self.max_cache_bytes is None:
+            return
+        if self._cache_bytes is None:
+            self._cache_bytes = sum(os.path.getsize(path) for path in self._cached_files())
+        else:
+            self._cache_bytes += size
+        if self._cache_bytes > self.max_cache_bytes:
+            self.evict()
+
+    def evict(self, target_bytes=None):
+        """Delete least recently used rendered pages until the cache is under ``target_bytes``."""
+        if target_bytes is None:
+            # 留出一点余量，避免每渲染一页就触发一次目录扫描
+            target_bytes = int(self.max_cache_bytes * 0.9)
+        files = []
+        for path in self._cached_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        with self.lock:
+            for _, size, path in files:
+                if total <= target_bytes:
+                    break
+                if path in self._recent:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._rendered.discard(path)
+                total -= size
+            self._rendered = {path for path in self._rendered if os.path.exists(path)}
+            self._write_rendered()
+        self._cache_bytes = total
+
+    def close(self):
+        with self.lock:
+            for pdf in self._documents.values():
+                pdf.close()
+            self._documents.clear()
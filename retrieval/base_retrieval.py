@@ -8,4 +8,28 @@ class BaseRetrieval():
         pass
     
     def find_top_k(self, dataset: BaseDataset):
-        pass
\ No newline at end of file
+        pass
+
+    def has_candidates(self, sample):
+        candidate_key = getattr(self.config, "candidate_key", None)
+        return bool(candidate_key and sample.get(candidate_key))
+
+    def allowed_pages(self, sample, page_id_key):
+        """Pages a sample may be ranked over: its page_id_key list, narrowed to first-stage candidates.
+
+        Candidates are read from ``candidate_key`` (e.g. BM25 results) when configured; None means every page.
+        """
+        page_ids = sample.get(page_id_key)
+        if not self.has_candidates(sample):
+            return page_ids
+        candidates = sample[self.config.candidate_key]
+        if page_ids:
+            allowed = set(page_ids)
+            candidates = [page for page in candidates if page in allowed] or page_ids
+        return sorted(candidates)
+
+    def candidate_union(self, samples, page_ids):
+        """Pages to score for a group of samples of one document, or None when some sample needs every page."""
+        if not all(self.has_candidates(sample) for sample in samples):
+            return None
+        return sorted(set().union(*page_ids))
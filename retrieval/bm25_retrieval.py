@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from retrieval.base_retrieval import BaseRetrieval
+from retrieval.maxsim import masked_top_k
+from retrieval.sparse_index import SparseIndex
+from mydatasets.base_dataset import BaseDataset
+
+
+class BM25Retrieval(BaseRetrieval):
+    """BM25 over the extracted page texts, CPU only.
+
+    Writes the top candidates_top_n pages to r_bm25_key; a dense retrieval run with
+    ``candidate_key`` set to that key then only rescores those pages. With
+    ``write_text_results`` the top_k pages also go to r_text_key, so BM25 replaces
+    ColBERT on its own (overwriting any ColBERT results there).
+    """
+    def __init__(self, config):
+        self.config = config
+
+    def index_path(self, dataset: BaseDataset):
+        return self.config.index_dir + "/" + dataset.config.name + "_bm25"
+
+    def prepare(self, dataset: BaseDataset):
+        index = SparseIndex(self.index_path(dataset))
+        samples = dataset.load_data(use_retreival=True)
+        for sample in tqdm(samples):
+            doc_id = sample[self.config.doc_key]
+            if doc_id in index:
+                continue
+            content_list = dataset.load_processed_content(sample)
+            index.put(doc_id, [content.txt for content in content_list])
+        return index
+
+    def find_top_k(self, dataset: BaseDataset):
+        top_k = self.config.top_k
+        write_text_results = getattr(self.config, "write_text_results", False)
+        n_candidates = max(self.config.candidates_top_n, top_k) if write_text_results else self.config.candidates_top_n
+        result_keys = [self.config.r_bm25_key] + ([self.config.r_text_key] if write_text_results else [])
+        index = self.prepare(dataset)
+        samples = dataset.load_data(use_retreival=True)
+
+        doc_groups: dict = {}
+        for sample in samples:
+            doc_groups.setdefault(sample[self.config.doc_key], []).append(sample)
+        for doc_id, group in tqdm(doc_groups.items()):
+            postings = index[doc_id]
+            if postings.n_pages == 0:
+                for sample in group:
+                    for key in result_keys:
+                        sample[key] = []
+                        sample[key+"_score"] = []
+                continue
+            scores = torch.from_numpy(np.stack([
+                postings.bm25(sample[self.config.text_question_key], self.config.k1, self.config.b) for sample in group
+            ]))
+            page_ids = [sample.get(dataset.config.page_id_key) for sample in group]
+            candidate_indices, candidate_scores = masked_top_k(scores, n_candidates, page_ids)
+            for sample, indices, page_scores in zip(group, candidate_indices, candidate_scores):
+                sample[self.config.r_bm25_key] = indices
+                sample[self.config.r_bm25_key+"_score"] = page_scores
+                if write_text_results:
+                    sample[self.config.r_text_key] = indices[:top_k]
+                    sample[self.config.r_text_key+"_score"] = page_scores[:top_k]
+        path = dataset.dump_data(samples, use_retreival=True)
+        print(f"Save retrieval results at {path}.")
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+
+def quantize_int8(array):
+    """Symmetric per-vector int8 quantization; returns codes and float16 scales of shape (..., 1)."""
+    scales = np.abs(array).max(axis=-1, keepdims=True) / 127.0
+    scales = np.where(scales == 0, 1.0, scales).astype(np.float16)
+    codes = np.clip(np.rint(array / scales.astype(np.float32)), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+class QuantizedEmbeds():
+    """Lazily dequantized view over int8 codes and their scales.
+
+    Indexing returns a float32 tensor for just the requested pages, which is
+    all ``maxsim_scores`` needs when it walks a document chunk by chunk.
+    """
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+        self.shape = codes.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        codes = torch.from_numpy(np.asarray(self.codes[index])).float()
+        scales = torch.from_numpy(np.asarray(self.scales[index])).float()
+        return codes * scales
+
+
+def pool_tokens(embeds, pool_factor: int, n_iter: int = 10, page_chunk_size: int = 32):
+    """Reduce every page to ceil(n_tokens / pool_factor) vectors by clustering similar tokens.
+
+    Tokens are grouped with a few rounds of spherical k-means (initialised from
+    evenly spaced tokens, so the result is deterministic) and each cluster is
+    replaced by its renormalised mean.
+
+    :param embeds: (n_pages, n_tokens, dim) tensor.
+    """
+    if pool_factor <= 1:
+        return embeds
+    if embeds.shape[0] > page_chunk_size:
+        # Similarity matrices are n_tokens x n_clusters per page, pool a few pages at a time
+        return torch.cat([
+            pool_tokens(embeds[start:start + page_chunk_size], pool_factor, n_iter, page_chunk_size)
+            for start in range(0, embeds.shape[0], page_chunk_size)
+        ])
+    n_pages, n_tokens, dim = embeds.shape
+    n_clusters = -(-n_tokens // pool_factor)
+    embeds = embeds.float()
+    init = torch.linspace(0, n_tokens - 1, n_clusters).round().long()
+    centroids = embeds[:, init]
+    for _ in range(n_iter):
+        assign = torch.einsum("ptd,pcd->ptc", embeds, centroids).argmax(dim=-1)
+        sums = torch.zeros_like(centroids).scatter_add_(1, assign.unsqueeze(-1).expand(-1, -1, dim), embeds)
+        counts = torch.zeros(n_pages, n_clusters, device=embeds.device).scatter_add_(
+            1, assign, torch.ones_like(assign, dtype=torch.float)
+        )
+        # Keep the previous centroid for clusters that lost all their tokens
+        centroids = torch.where(counts.unsqueeze(-1) > 0, sums / counts.clamp(min=1).unsqueeze(-1), centroids)
+    return torch.nn.functional.normalize(centroids, dim=-1)
+
+
+class EmbeddingStore():
+    """On-disk store of per-document page embeddings.
+
+    Every document is saved as its own ``.npy`` array next to a small JSON
+    index, and the index is flushed after each ``put`` so an interrupted
+    ``prepare`` keeps everything embedded so far. Arrays are opened with
+    ``mmap``, so only the documents (and pages) actually scored are read.
+    ``dtype`` may be ``float32``, ``float16`` or ``int8`` (per-vector scales
+    are stored in a sibling ``.scale.npy``).
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root, dtype="float32"):
+        self.root = root
+        self.dtype = dtype
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+
+    @classmethod
+    def exists(cls, root):
+        return os.path.exists(os.path.join(root, cls.INDEX_FILE))
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def file_name(self, doc_id):
+        return hashlib.sha1(doc_id.encode("utf-8")).hexdigest()[:20] + ".npy"
+
+    def put(self, doc_id, embeds):
+        """Save one document's (n_pages, n_tokens, dim) embeddings; None marks an empty document."""
+        os.makedirs(self.root, exist_ok=True)
+        if embeds is None:
+            self.index[doc_id] = None
+        else:
+            array = embeds.detach().float().cpu().numpy()
+            file_name = self.file_name(doc_id)
+            path = os.path.join(self.root, file_name)
+            if self.dtype == "int8":
+                array, scales = quantize_int8(array)
+                self._save(path[:-len(".npy")] + ".scale.npy", scales)
+            else:
+                array = array.astype(self.dtype)
+            self._save(path, array)
+            self.index[doc_id] = {"file": file_name, "shape": list(array.shape), "dtype": str(array.dtype)}
+        self.flush()
+
+    def _save(self, path, array):
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, array)
+        os.replace(path + ".tmp", path)
+
+    def flush(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def __getitem__(self, doc_id):
+        entry = self.index[doc_id]
+        if entry is None:
+            return None
+        # Copy-on-write mapping: pages are read lazily and the tensor stays writable for torch
+        path = os.path.join(self.root, entry["file"])
+        array = np.load(path, mmap_mode="c")
+        if entry["dtype"] == "int8":
+            scales = np.load(path[:-len(".npy")] + ".scale.npy", mmap_mode="c")
+            return QuantizedEmbeds(array, scales)
+        return torch.from_numpy(array)
+
+    def get(self, doc_id, default=None):
+        return self[doc_id] if doc_id in self.index else default
+
+    def fingerprint(self, doc_id):
+        """Identity of a document's stored embeddings, changes whenever they are rewritten."""
+        entry = self.index.get(doc_id)
+        if entry is None:
+            return "empty" if doc_id in self.index else None
+        stat = os.stat(os.path.join(self.root, entry["file"]))
+        return f"{entry['dtype']}-{stat.st_size}-{stat.st_mtime_ns}"
+
+    def nbytes(self):
+        total = 0
+        for entry in self.index.values():
+            if entry is None:
+                continue
+            path = os.path.join(self.root, entry["file"])
+            total += os.path.getsize(path)
+            if entry["dtype"] == "int8":
+                total += os.path.getsize(path[:-len(".npy")] + ".scale.npy")
+        return total
+
+
+class FlatMultiVectorStore():
+    """Token vectors of a whole dataset in one flat, append-only file.
+
+    ``tokens.bin`` holds every token vector back to back (float16 or float32);
+    ``index.json`` records where each unit (a page or a passage) starts, the
+    page each unit belongs to, and each document's range of units. Scoring a
+    question reads only its document's units from the memory-mapped file, so a
+    dataset needs one store instead of one index per document. The index is
+    flushed every ``flush_every`` documents; on reopen, vectors written after
+    the last flush are dropped and recomputed.
+    """
+    DATA_FILE = "tokens.bin"
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root, dim=128, dtype="float16", flush_every=64):
+        self.root = root
+        self.data_path = os.path.join(root, self.DATA_FILE)
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self.flush_every = flush_every
+        self.index = {"dim": dim, "dtype": dtype, "offsets": [0], "pages": [], "docs": {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        self.dim = self.index["dim"]
+        self.dtype = np.dtype(self.index["dtype"])
+        self._tokens = None
+        self._pending = 0
+        os.makedirs(root, exist_ok=True)
+        # Drop anything appended after the last flushed index
+        with open(self.data_path, "ab") as f:
+            f.truncate(self.index["offsets"][-1] * self.dim * self.dtype.itemsize)
+
+    @classmethod
+    def exists(cls, root):
+        return os.path.exists(os.path.join(root, cls.INDEX_FILE))
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index["docs"]
+
+    def __len__(self):
+        return len(self.index["docs"])
+
+    def add(self, doc_id, embeds, pages=None):
+        """Append one document as a list of (n_tokens_i, dim) unit tensors; pages[i] is unit i's page (default i)."""
+        offsets = self.index["offsets"]
+        first = len(offsets) - 1
+        with open(self.data_path, "ab") as f:
+            for embed in embeds:
+                array = embed.detach().float().cpu().numpy().astype(self.dtype)
+                f.write(array.tobytes())
+                offsets.append(offsets[-1] + array.shape[0])
+        self.index["pages"].extend(pages if pages is not None else range(len(embeds)))
+        # The write time tells a rebuilt document from an earlier one at the same offsets
+        self.index["docs"][doc_id] = [first, len(offsets) - 1, time.time_ns()]
+        self._tokens = None
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self._pending = 0
+
+    def fingerprint(self, doc_id):
+        entry = self.index["docs"].get(doc_id)
+        return None if entry is None else "-".join(str(value) for value in [self.index["dtype"]] + entry)
+
+    def tokens(self):
+        if self._tokens is None:
+            n_tokens = self.index["offsets"][-1]
+            if n_tokens == 0:
+                self._tokens = np.zeros((0, self.dim), dtype=self.dtype)
+            else:
+                self._tokens = np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(n_tokens, self.dim))
+        return self._tokens
+
+    def get_doc(self, doc_id):
+        """Padded (n_units, max_tokens, dim) float32 tensor, its token mask and the page of each unit.
+
+        Returns (None, None, []) for documents stored without units.
+        """
+        first, end = self.index["docs"][doc_id][:2]
+        if end == first:
+            return None, None, []
+        offsets = self.index["offsets"][first:end + 1]
+        tokens = torch.from_numpy(np.array(self.tokens()[offsets[0]:offsets[-1]], dtype=np.float32))
+        lengths = [stop - start for start, stop in zip(offsets[:-1], offsets[1:])]
+        padded = torch.zeros(len(lengths), max(max(lengths), 1), self.dim)
+        mask = torch.zeros(padded.shape[:2], dtype=torch.bool)
+        for unit, (start, length) in enumerate(zip(offsets[:-1], lengths)):
+            begin = start - offsets[0]
+            padded[unit, :length] = tokens[begin:begin + length]
+            mask[unit, :length] = True
+        return padded, mask, self.index["pages"][first:end]
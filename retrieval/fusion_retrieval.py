@@ -0,0 +1,67 @@
+from tqdm import tqdm
+
+from retrieval.base_retrieval import BaseRetrieval
+from mydatasets.base_dataset import BaseDataset
+
+
+def reciprocal_rank_fusion(rankings, weights, k=60):
+    """score(page) = sum_m weight_m / (k + rank_m(page)), ranks starting at 1."""
+    fused = {}
+    for pages, weight in zip(rankings, weights):
+        for rank, page in enumerate(pages, start=1):
+            fused[page] = fused.get(page, 0.0) + weight / (k + rank)
+    return fused
+
+
+def weighted_score_fusion(rankings, score_lists, weights):
+    """Min-max normalize each modality's scores per sample, then add them up with weights."""
+    fused = {}
+    for pages, scores, weight in zip(rankings, score_lists, weights):
+        if not pages:
+            continue
+        low, high = min(scores), max(scores)
+        for page, score in zip(pages, scores):
+            normalized = (score - low) / (high - low) if high > low else 1.0
+            fused[page] = fused.get(page, 0.0) + weight * normalized
+    return fused
+
+
+class FusionRetrieval(BaseRetrieval):
+    """Fuses the stored text (ColBERT) and image (ColPali) rankings of every sample into r_mix_key.
+
+    Nothing is re-scored: it reads r_text_key / r_image_key and their ``_score`` lists,
+    so both retrievals have to be run first.
+    """
+    def __init__(self, config):
+        self.config = config
+
+    def fuse(self, sample):
+        rankings, score_lists, weights = [], [], []
+        for key, weight in (
+            (self.config.r_text_key, getattr(self.config, "text_weight", 1.0)),
+            (self.config.r_image_key, getattr(self.config, "image_weight", 1.0)),
+        ):
+            rankings.append(sample.get(key, []))
+            score_lists.append(sample.get(key+"_score", []))
+            weights.append(weight)
+        if getattr(self.config, "fusion_mode", "rrf") == "weighted":
+            fused = weighted_score_fusion(rankings, score_lists, weights)
+        else:
+            fused = reciprocal_rank_fusion(rankings, weights, k=getattr(self.config, "rrf_k", 60))
+        # Ties keep the text ranking's order first, sorted() is stable
+        top = sorted(fused.items(), key=lambda item: -item[1])[:self.config.top_k]
+        return [page for page, _ in top], [score for _, score in top]
+
+    def find_top_k(self, dataset: BaseDataset):
+        samples = dataset.load_data(use_retreival=True)
+        missing = 0
+        for sample in tqdm(samples):
+            if self.config.r_text_key not in sample or self.config.r_image_key not in sample:
+                missing += 1
+            pages, scores = self.fuse(sample)
+            sample[self.config.r_mix_key] = pages
+            sample[self.config.r_mix_key+"_score"] = scores
+        if missing:
+            print(f"[WARNING] {missing} samples lack text or image retrieval results; they are fused from what exists.")
+        path = dataset.dump_data(samples, use_retreival=True)
+        print(f"Save retrieval results at {path}.")
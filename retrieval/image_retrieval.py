@@ -5,12 +5,14 @@ from tqdm import tqdm
 import os
 import pickle
 from colpali_engine.models.paligemma_colbert_architecture import ColPali
-from colpali_engine.trainer.retrieval_evaluator import CustomEvaluator
 from colpali_engine.utils.colpali_processing_utils import process_images, process_queries
 from transformers import AutoProcessor
 
 from mydatasets.base_dataset import BaseDataset
 from retrieval.base_retrieval import BaseRetrieval
+from retrieval.maxsim import maxsim_scores, masked_top_k
+from retrieval.embed_store import EmbeddingStore, pool_tokens
+from retrieval.memo import RetrievalMemo, select_pages, combine_fingerprints
 
 class ColpaliRetrieval(BaseRetrieval):
     def __init__(self, config):
@@ -19,93 +21,160 @@ class ColpaliRetrieval(BaseRetrieval):
         self.model = ColPali.from_pretrained("vidore/colpaligemma-3b-mix-448-base", torch_dtype=torch.float32, device_map="auto").eval()
         self.model.load_adapter(model_name)
         self.processor = AutoProcessor.from_pretrained(model_name)
+        self.mock_image = Image.new("RGB", (448, 448), (255, 255, 255))
+        self.query_embeds = {}
     
+    def embed_store_path(self, dataset: BaseDataset):
+        # Compressed variants get their own store so they never mix with full-precision embeddings
+        path = self.config.embed_dir + "/" + dataset.config.name + "_embeds"
+        dtype = getattr(self.config, "embed_dtype", "float32")
+        pool_factor = getattr(self.config, "embed_pool_factor", 1)
+        if dtype != "float32":
+            path += "_" + dtype
+        if pool_factor > 1:
+            path += f"_pool{pool_factor}"
+        return path
+
     def prepare(self, dataset: BaseDataset):
         os.makedirs(self.config.embed_dir, exist_ok=True)
+        document_embeds = EmbeddingStore(self.embed_store_path(dataset), dtype=getattr(self.config, "embed_dtype", "float32"))
+
+        # Import embeddings from the old single-pickle layout instead of recomputing them
         embed_path = self.config.embed_dir + "/" + dataset.config.name + "_embed.pkl"
-        if os.path.exists(embed_path):
+        if os.path.exists(embed_path) and len(document_embeds) == 0:
             with open(embed_path, "rb") as file:  # Use "rb" mode for binary reading
-                document_embeds = pickle.load(file)
-        else:
-            document_embeds = {}
+                legacy_embeds = pickle.load(file)
+            pool_factor = getattr(self.config, "embed_pool_factor", 1)
+            for doc_id, embeds in tqdm(legacy_embeds.items()):
+                # Pool like a fresh build so the store matches its _poolN path
+                document_embeds.put(doc_id, None if embeds is None else pool_tokens(embeds.cpu(), pool_factor))
+            del legacy_embeds
         
         samples = dataset.load_data(use_retreival=True)
         for sample in tqdm(samples):
             if sample[self.config.doc_key] in document_embeds:
                 continue
             content_list = dataset.load_processed_content(sample, disable_load_image=False)
-            images = [content.image for content in content_list]
+            # Pull images per batch so lazily rendered pages are only held in memory one batch at a time
             dataloader = DataLoader(
-                images,
+                content_list,
                 batch_size=self.config.batch_size,
                 shuffle=False,
-                collate_fn=lambda x: process_images(self.processor, x).to(self.model.device),
+                collate_fn=lambda x: process_images(self.processor, [content.image for content in x]).to(self.model.device),
             )
             image_embeds = []
             for batch_image in dataloader:
                 with torch.no_grad():
                     batch_image = {k: v.to(self.model.device) for k, v in batch_image.items()}
                     batch_image_embed = self.model(**batch_image)
-                    image_embeds.extend(batch_image_embed)
-            try:
-                document_embeds[sample[self.config.doc_key]] = torch.stack(image_embeds,axis=0)
-            except:
-                document_embeds[sample[self.config.doc_key]] = None
+                    image_embeds.extend(batch_image_embed.cpu())
+            # Flushed per document, so a crash only loses the document in progress
+            if image_embeds:
+                image_embeds = pool_tokens(torch.stack(image_embeds,axis=0), getattr(self.config, "embed_pool_factor", 1))
+                document_embeds.put(sample[self.config.doc_key], image_embeds)
+            else:
+                document_embeds.put(sample[self.config.doc_key], None)
                 print("Empty doc.")
-        
-        with open(embed_path, "wb") as f:
-            pickle.dump(document_embeds, f)
             
         return document_embeds
             
+    def encode_queries(self, queries):
+        """Encode questions in batches; each distinct question text is encoded once per run."""
+        missing = [query for query in dict.fromkeys(queries) if query not in self.query_embeds]
+        batch_size = getattr(self.config, "query_batch_size", None) or self.config.batch_size
+        for start in tqdm(range(0, len(missing), batch_size), disable=len(missing) <= batch_size):
+            batch = missing[start:start+batch_size]
+            batch_queries = process_queries(self.processor, batch, self.mock_image).to(self.model.device)
+            with torch.no_grad():
+                batch_query_embed = self.model(**batch_queries)
+            # Padding positions are zeroed by the model, drop them so cached embeddings match unbatched ones
+            for query, query_embed, mask in zip(batch, batch_query_embed, batch_queries["attention_mask"]):
+                self.query_embeds[query] = query_embed[mask.bool()]
+        return [self.query_embeds[query] for query in queries]
+
+    def score_queries(self, query_embeds, document_embed, pages=None):
+        """Late-interaction scores of every query against every page, shape (n_queries, n_pages).
+
+        With pages given only those are scored; the others get -inf.
+        """
+        chunk_size = getattr(self.config, "score_chunk_size", 64)
+        if pages is None:
+            return maxsim_scores(query_embeds, document_embed, chunk_size=chunk_size)
+        page_scores = maxsim_scores(query_embeds, document_embed[pages], chunk_size=chunk_size)
+        scores = torch.full((page_scores.shape[0], len(document_embed)), float("-inf"), device=page_scores.device)
+        scores[:, pages] = page_scores
+        return scores
+
     def find_sample_top_k(self, sample, document_embed, top_k: int, page_id_key: str):
-        query = [sample[self.config.image_question_key]]
-        batch_queries = process_queries(self.processor, query, Image.new("RGB", (448, 448), (255, 255, 255))).to(self.model.device)
-        with torch.no_grad():    
-            query_embed = self.model(**batch_queries)
-        
-        page_id_list = None
-        if page_id_key in sample:
-            page_id_list = sample[page_id_key]
-            assert isinstance(page_id_list, list)
-            
-        retriever_evaluator = CustomEvaluator(is_multi_vector=True)
-        scores = retriever_evaluator.evaluate(query_embed, document_embed)
-        
-        if page_id_list:
-            scores_tensor = torch.tensor(scores)
-            mask = torch.zeros_like(scores_tensor, dtype=torch.bool)
-            for idx in page_id_list:
-                mask[0, idx] = True
-            masked_scores = torch.where(mask, scores_tensor, torch.full_like(scores_tensor, float('-inf')))
-            top_page = torch.topk(masked_scores, min(top_k, len(page_id_list)), dim=-1)
-        else:
-            top_page = torch.topk(torch.tensor(scores), min(top_k,len(scores[0])), dim=-1)
-            
-        top_page_scores = top_page.values.tolist()[0] if top_page is not None else []
-        top_page_indices = top_page.indices.tolist()[0] if top_page is not None else []
-        
-        return top_page_indices, top_page_scores
-        
+        query_embeds = self.encode_queries([sample[self.config.image_question_key]])
+        scores = self.score_queries(query_embeds, document_embed)
+        top_page_indices, top_page_scores = masked_top_k(scores, top_k, [self.allowed_pages(sample, page_id_key)])
+        return top_page_indices[0], top_page_scores[0]
+
     def find_top_k(self, dataset: BaseDataset, prepare=False):
         document_embeds = self.load_document_embeds(dataset, force_prepare=prepare)
         top_k = self.config.top_k
         samples = dataset.load_data(use_retreival=True)
-        for sample in tqdm(samples):
+        # Full rankings of earlier runs (any top_k) live next to the embeddings of the same store
+        memo = RetrievalMemo.from_config(self.config, ":".join([
+            os.path.basename(self.embed_store_path(dataset)), getattr(self.config, "embed_dtype", "float32"),
+            f"pool{getattr(self.config, 'embed_pool_factor', 1)}",
+        ]))
+
+        doc_groups: dict = {}
+        fingerprints = {}
+        for sample in samples:
             if self.config.r_image_key in sample:
                 continue
-            document_embed = document_embeds[sample[self.config.doc_key]]
-            top_page_indices, top_page_scores = self.find_sample_top_k(sample, document_embed, top_k, dataset.config.page_id_key)
-            sample[self.config.r_image_key] = top_page_indices
-            sample[self.config.r_image_key+"_score"] = top_page_scores
+            doc_id = sample[self.config.doc_key]
+            if memo is not None:
+                if doc_id not in fingerprints:
+                    fingerprints[doc_id] = combine_fingerprints(
+                        dataset.document_fingerprint(sample), document_embeds.fingerprint(doc_id)
+                    )
+                ranking = memo.get(doc_id, sample[self.config.image_question_key], fingerprints[doc_id])
+                if ranking is not None:
+                    sample[self.config.r_image_key], sample[self.config.r_image_key+"_score"] = select_pages(
+                        *ranking, top_k, self.allowed_pages(sample, dataset.config.page_id_key)
+                    )
+                    continue
+            doc_groups.setdefault(doc_id, []).append(sample)
+        self.encode_queries([sample[self.config.image_question_key] for group in doc_groups.values() for sample in group])
+
+        for doc_id, group in tqdm(doc_groups.items()):
+            document_embed = document_embeds[doc_id]
+            if document_embed is None:
+                for sample in group:
+                    sample[self.config.r_image_key] = []
+                    sample[self.config.r_image_key+"_score"] = []
+                continue
+            query_embeds = self.encode_queries([sample[self.config.image_question_key] for sample in group])
+            page_ids = [self.allowed_pages(sample, dataset.config.page_id_key) for sample in group]
+            # With first-stage candidates only pages some question of the group may return are scored
+            pages = self.candidate_union(group, page_ids)
+            scores = self.score_queries(query_embeds, document_embed, pages)
+            if memo is not None and pages is None:
+                # Rank every page once, memoize the full ranking and cut it per sample
+                all_indices, all_scores = masked_top_k(scores, scores.shape[1])
+                for sample, indices, page_scores, ids in zip(group, all_indices, all_scores, page_ids):
+                    memo.put(doc_id, sample[self.config.image_question_key], fingerprints[doc_id], indices, page_scores)
+                    sample[self.config.r_image_key], sample[self.config.r_image_key+"_score"] = select_pages(
+                        indices, page_scores, top_k, ids
+                    )
+                continue
+            top_page_indices, top_page_scores = masked_top_k(scores, top_k, page_ids)
+            for sample, indices, page_scores in zip(group, top_page_indices, top_page_scores):
+                sample[self.config.r_image_key] = indices
+                sample[self.config.r_image_key+"_score"] = page_scores
+        if memo is not None:
+            print(f"Retrieval memo: {memo.stats()}")
         path = dataset.dump_data(samples, use_retreival=True)
         print(f"Save retrieval results at {path}.")
         
     def load_document_embeds(self, dataset: BaseDataset, force_prepare=False):
-        embed_path = self.config.embed_dir + "/" + dataset.config.name + "_embed.pkl"
-        if os.path.exists(embed_path) and not force_prepare:
-            with open(embed_path, "rb") as file:  # Use "rb" mode for binary reading
-                document_embeds = pickle.load(file)
+        store_path = self.embed_store_path(dataset)
+        if EmbeddingStore.exists(store_path) and not force_prepare:
+            document_embeds = EmbeddingStore(store_path, dtype=getattr(self.config, "embed_dtype", "float32"))
         else:
             document_embeds = self.prepare(dataset)
-        return document_embeds
\ No newline at end of file
+        return document_embeds
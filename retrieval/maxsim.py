@@ -0,0 +1,82 @@
+import torch
+
+
+def pad_multi_vectors(embeds, device=None, dtype=None):
+    """Stack variable-length multi-vector embeddings into one padded tensor.
+
+    :param embeds: list of (n_tokens_i, dim) tensors.
+    :return: (len(embeds), max_tokens, dim) tensor and a (len(embeds), max_tokens) bool token mask.
+    """
+    max_len = max(embed.shape[0] for embed in embeds)
+    dim = embeds[0].shape[-1]
+    device = device if device is not None else embeds[0].device
+    dtype = dtype if dtype is not None else embeds[0].dtype
+    padded = torch.zeros(len(embeds), max_len, dim, device=device, dtype=dtype)
+    mask = torch.zeros(len(embeds), max_len, device=device, dtype=torch.bool)
+    for i, embed in enumerate(embeds):
+        padded[i, :embed.shape[0]] = embed.to(device=device, dtype=dtype)
+        mask[i, :embed.shape[0]] = True
+    return padded, mask
+
+
+@torch.no_grad()
+def maxsim_scores(query_embeds, page_embeds, query_mask=None, page_mask=None, chunk_size=64):
+    """Late-interaction (MaxSim) scores: ``score[q, p] = sum_i max_j <query_i, page_j>``.
+
+    :param query_embeds: (n_queries, query_len, dim) tensor, or a list of (query_len_i, dim) tensors.
+    :param page_embeds: (n_pages, page_len, dim) tensor; it may live on CPU or be memory-mapped,
+        pages are moved to the query device one chunk at a time.
+    :param query_mask: optional (n_queries, query_len) bool mask of real query tokens.
+    :param page_mask: optional (n_pages, page_len) bool mask of real page tokens.
+    :param chunk_size: pages scored per step; bounds peak memory to
+        n_queries * query_len * chunk_size * page_len similarities.
+    :return: (n_queries, n_pages) float32 tensor on the query device.
+    """
+    if isinstance(query_embeds, (list, tuple)):
+        query_embeds, query_mask = pad_multi_vectors(query_embeds)
+    device = query_embeds.device
+    # Half precision matmuls are slow or missing on CPU, score there in float32
+    dtype = query_embeds.dtype if device.type == "cuda" else torch.float32
+    query_embeds = query_embeds.to(dtype)
+
+    n_pages = page_embeds.shape[0]
+    scores = torch.empty(query_embeds.shape[0], n_pages, device=device, dtype=torch.float32)
+    for start in range(0, n_pages, chunk_size):
+        end = min(start + chunk_size, n_pages)
+        pages = torch.as_tensor(page_embeds[start:end]).to(device=device, dtype=dtype)
+        sim = torch.einsum("qid,pjd->qpij", query_embeds, pages)
+        if page_mask is not None:
+            chunk_mask = torch.as_tensor(page_mask[start:end]).to(device)
+            sim = sim.masked_fill(~chunk_mask[None, :, None, :], float("-inf"))
+        best = sim.max(dim=-1).values
+        if query_mask is not None:
+            best = best.masked_fill(~query_mask[:, None, :], 0)
+        scores[:, start:end] = best.sum(dim=-1).float()
+    return scores
+
+
+def masked_top_k(scores, top_k: int, page_ids=None):
+    """Top-k pages per query, optionally restricting each query to its own candidate pages.
+
+    :param scores: (n_queries, n_pages) tensor.
+    :param page_ids: optional list with one entry per query; an entry is a list/tensor of
+        allowed page indices, or None/empty to allow every page.
+    :return: lists of page indices and scores per query.
+    """
+    n_queries, n_pages = scores.shape
+    limits = [min(top_k, n_pages)] * n_queries
+    if page_ids is not None and any(ids is not None and len(ids) > 0 for ids in page_ids):
+        rows, cols = [], []
+        for row, ids in enumerate(page_ids):
+            ids = torch.arange(n_pages) if ids is None or len(ids) == 0 else torch.as_tensor(ids, dtype=torch.long)
+            rows.append(torch.full_like(ids, row))
+            cols.append(ids)
+            limits[row] = min(top_k, len(ids))
+        mask = torch.zeros_like(scores, dtype=torch.bool)
+        mask[torch.cat(rows).to(scores.device), torch.cat(cols).to(scores.device)] = True
+        scores = torch.where(mask, scores, torch.full_like(scores, float("-inf")))
+
+    top_page = torch.topk(scores, max(limits), dim=-1)
+    indices = top_page.indices.tolist()
+    values = top_page.values.tolist()
+    return [row[:limit] for row, limit in zip(indices, limits)], [row[:limit] for row, limit in zip(values, limits)]
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from mydatasets.kv_store import DiskKVStore
+
+
+def normalize_question(question):
+    # Only whitespace: ColPali's tokenizer is case-sensitive, so case is kept
+    return " ".join(question.split())
+
+
+def path_fingerprint(path):
+    """Size and mtime of a file, or of every file in a directory; None if path is missing."""
+    if not os.path.exists(path):
+        return None
+    paths = [path] if os.path.isfile(path) else sorted(
+        os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+    )
+    stats = [(os.path.relpath(name, path), os.stat(name).st_size, os.stat(name).st_mtime_ns) for name in paths]
+    return hashlib.sha1(json.dumps(stats).encode("utf-8")).hexdigest()
+
+
+def combine_fingerprints(*parts):
+    """One fingerprint of a document and its index/embeddings; None if any part is unknown."""
+    if any(part is None for part in parts):
+        return None
+    return ":".join(str(part) for part in parts)
+
+
+def select_pages(pages, scores, top_k, page_ids=None):
+    """Top-k of a full ranking, restricted to page_ids if given."""
+    if page_ids:
+        allowed = set(page_ids)
+        ranked = [(page, score) for page, score in zip(pages, scores) if page in allowed]
+    else:
+        ranked = list(zip(pages, scores))
+    ranked = ranked[:top_k]
+    return [page for page, _ in ranked], [score for _, score in ranked]
+
+
+class RetrievalMemo():
+    """Full page rankings per (retriever, document, question), kept on disk between runs.
+
+    The whole ranking is stored, so any top_k or page_ids restriction is answered from
+    the same entry. Keys include the document's fingerprint (see
+    BaseDataset.document_fingerprint) combined with the fingerprint of its index or
+    embeddings, so re-extracting a document or rebuilding its index invalidates its
+    entries, which are then dropped by the store's size-based eviction. Settings that
+    change every document's ranking (model, dtype, pooling, chunking) belong in
+    retriever_key.
+    """
+    def __init__(self, path, retriever_key, max_mb=None):
+        self.store = DiskKVStore(path, max_bytes=max_mb * 1024 * 1024 if max_mb else None)
+        self.retriever_key = retriever_key
+
+    @classmethod
+    def from_config(cls, config, retriever_key):
+        path = getattr(config, "memo_path", None)
+        if not path:
+            return None
+        return cls(path, retriever_key, getattr(config, "memo_size_mb", None))
+
+    def key(self, doc_id, question, fingerprint):
+        payload = [self.retriever_key, doc_id, normalize_question(question), fingerprint]
+        return hashlib.sha1(json.dumps(payload).encode("utf-8")).hexdigest()
+
+    def get(self, doc_id, question, fingerprint):
+        """(pages, scores) of the full ranking, or None."""
+        if fingerprint is None:
+            return None
+        value = self.store.get_json(self.key(doc_id, question, fingerprint))
+        return None if value is None else (value["pages"], value["scores"])
+
+    def put(self, doc_id, question, fingerprint, pages, scores):
+        if fingerprint is None:
+            return
+        self.store.put_json(self.key(doc_id, question, fingerprint), {"pages": pages, "scores": scores})
+
+    def stats(self):
+        return self.store.stats()
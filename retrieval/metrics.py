@@ -0,0 +1,14 @@
+import ast
+
+
+def evidence_pages(sample):
+    """0-based evidence pages of a sample from its 1-based ``evidence_pages`` (list or its string form), or None."""
+    pages = sample.get("evidence_pages")
+    if isinstance(pages, str):
+        try:
+            pages = ast.literal_eval(pages)
+        except (ValueError, SyntaxError):
+            return None
+    if not pages:
+        return None
+    return {page - 1 for page in pages}
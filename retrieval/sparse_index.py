@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class DocumentPostings():
+    """Inverted index of one document's pages: sorted vocabulary plus CSR postings."""
+    def __init__(self, terms, indptr, pages, tfs, page_lens):
+        self.terms = terms
+        self.indptr = indptr
+        self.pages = pages
+        self.tfs = tfs
+        self.page_lens = page_lens
+
+    @classmethod
+    def build(cls, texts):
+        counts = {}
+        page_lens = np.zeros(len(texts), dtype=np.float32)
+        for page, text in enumerate(texts):
+            tokens = tokenize(text)
+            page_lens[page] = len(tokens)
+            for token in tokens:
+                term_pages = counts.setdefault(token, {})
+                term_pages[page] = term_pages.get(page, 0) + 1
+        terms = sorted(counts)
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        pages, tfs = [], []
+        for i, term in enumerate(terms):
+            pages.extend(counts[term].keys())
+            tfs.extend(counts[term].values())
+            indptr[i + 1] = len(pages)
+        return cls(
+            np.array(terms, dtype=str), indptr,
+            np.array(pages, dtype=np.int32), np.array(tfs, dtype=np.float32), page_lens,
+        )
+
+    @property
+    def n_pages(self):
+        return len(self.page_lens)
+
+    def bm25(self, query, k1=1.5, b=0.75):
+        """BM25 score of every page for one query, shape (n_pages,)."""
+        scores = np.zeros(self.n_pages, dtype=np.float32)
+        tokens = np.array(tokenize(query), dtype=str)
+        if len(tokens) == 0 or len(self.terms) == 0:
+            return scores
+        positions = np.minimum(np.searchsorted(self.terms, tokens), len(self.terms) - 1)
+        term_ids = positions[self.terms[positions] == tokens]
+        if len(term_ids) == 0:
+            return scores
+        starts, ends = self.indptr[term_ids], self.indptr[term_ids + 1]
+        dfs = (ends - starts).astype(np.float32)
+        # Lucene's idf, never negative even for terms on most pages
+        idfs = np.log1p((self.n_pages - dfs + 0.5) / (dfs + 0.5))
+        # Gather every posting of every query term in one go
+        lengths = ends - starts
+        posting = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        pages, tfs = self.pages[posting], self.tfs[posting]
+        avg_len = max(float(self.page_lens.mean()), 1.0)
+        norm = k1 * (1 - b + b * self.page_lens[pages] / avg_len)
+        weights = np.repeat(idfs, lengths) * tfs * (k1 + 1) / (tfs + norm)
+        return np.bincount(pages, weights=weights, minlength=self.n_pages).astype(np.float32)
+
+
+class SparseIndex():
+    """On-disk BM25 inverted indexes, one ``.npz`` per document next to a JSON index.
+
+    Like EmbeddingStore, the index is flushed after each ``put`` so an interrupted
+    build keeps every document indexed so far.
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+
+    @classmethod
+    def exists(cls, root):
+        return os.path.exists(os.path.join(root, cls.INDEX_FILE))
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def file_name(self, doc_id):
+        return hashlib.sha1(doc_id.encode("utf-8")).hexdigest()[:20] + ".npz"
+
+    def put(self, doc_id, texts):
+        """Index one document given its page texts."""
+        os.makedirs(self.root, exist_ok=True)
+        postings = DocumentPostings.build(texts)
+        file_name = self.file_name(doc_id)
+        path = os.path.join(self.root, file_name)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(
+                f, terms=postings.terms, indptr=postings.indptr, pages=postings.pages,
+                tfs=postings.tfs, page_lens=postings.page_lens,
+            )
+        os.replace(path + ".tmp", path)
+        self.index[doc_id] = {"file": file_name, "n_pages": postings.n_pages, "n_terms": len(postings.terms)}
+        self.flush()
+        return postings
+
+    def flush(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def __getitem__(self, doc_id):
+        with np.load(os.path.join(self.root, self.index[doc_id]["file"])) as data:
+            return DocumentPostings(data["terms"], data["indptr"], data["pages"], data["tfs"], data["page_lens"])
@@ -1,17 +1,59 @@
 import os
 import json
+from collections import OrderedDict
+import torch
 from tqdm import tqdm
 from ragatouille import RAGPretrainedModel
+from colbert import Searcher
+from colbert.infra import ColBERTConfig
+from colbert.search.index_storage import IndexScorer
 
 from retrieval.base_retrieval import BaseRetrieval
+from retrieval.embed_store import FlatMultiVectorStore
+from retrieval.maxsim import maxsim_scores, masked_top_k
+from retrieval.memo import RetrievalMemo, select_pages, combine_fingerprints, path_fingerprint
 from mydatasets.base_dataset import BaseDataset
 
+class IndexSearcher(Searcher):
+    """ColBERT searcher over one document's PLAID index that reuses an already loaded checkpoint.
+
+    RAGPretrainedModel.from_index and Searcher.__init__ both load the checkpoint again for every
+    index; here only the index itself is read and all indexes share one encoder. Search settings
+    follow RAGatouille's for small collections.
+    """
+    def __init__(self, index_path, checkpoint):
+        self.verbose = 0
+        self.index = index_path
+        self.index_config = ColBERTConfig.load_from_index(index_path)
+        self.checkpoint = checkpoint
+        self.config = ColBERTConfig.from_existing(checkpoint.colbert_config, self.index_config)
+        self.configure(ndocs=1024, ncells=8, centroid_score_threshold=0.4)
+        self.ranker = IndexScorer(index_path, self.config.total_visible_gpus > 0, False)
+        self.max_query_tokens = checkpoint.bert.config.max_position_embeddings - 4
+
+    def rank_passages(self, queries, k, pids=None):
+        """Top k passages of each query as [{"passage_id", "score"}], like RAGPretrainedModel.search."""
+        base_ndocs = self.config.ndocs
+        self.configure(ndocs=max(k * 4, base_ndocs))
+        # Same query length rule as RAGatouille: ~1.35 tokens per word, at least 32
+        longest = max(int(len(query.split(" ")) * 1.35) for query in queries)
+        self.configure(query_maxlen=min(max(longest, 32), self.max_query_tokens))
+        Q = self.encode(queries)
+        results = []
+        for i in range(len(queries)):
+            passage_ids, _, scores = self.dense_search(Q[i:i+1], k, pids=pids)
+            results.append([{"passage_id": pid, "score": score} for pid, score in zip(passage_ids, scores)])
+        self.configure(ndocs=base_ndocs)
+        return results
+
+
 class ColbertRetrieval(BaseRetrieval):
     def __init__(self, config):
         self.config = config
+        self.index_cache = OrderedDict()
+        self.checkpoint = None
 
-    def prepare(self, dataset: BaseDataset):
-        samples = dataset.load_data(use_retreival=True)
+    def load_pretrained(self):
         model_path = getattr(self.config, "pretrained_model_path", "colbert-ir/colbertv2.0")
 
         print(f"[INFO] Attempting to load RAG model from: {model_path}")
@@ -44,6 +86,19 @@ class ColbertRetrieval(BaseRetrieval):
         except Exception as e:
             print(f"[ERROR] Failed to load RAG model from: {hf_identifier}")
             raise e
+        return RAG
+
+    def load_checkpoint(self):
+        """The ColBERT encoder, loaded once and shared by every index."""
+        if self.checkpoint is None:
+            self.checkpoint = self.load_pretrained().model.inference_ckpt
+            if torch.cuda.is_available():
+                self.checkpoint = self.checkpoint.cuda()
+        return self.checkpoint
+
+    def prepare(self, dataset: BaseDataset):
+        samples = dataset.load_data(use_retreival=True)
+        RAG = self.load_pretrained()
 
         doc_index: dict = {}
         error = 0
@@ -79,25 +134,34 @@ class ColbertRetrieval(BaseRetrieval):
 
         return samples
 
-    def find_sample_top_k(self, sample, top_k: int, page_id_key: str):
-        if not os.path.exists(sample[self.config.r_text_index_key]+"/pid_docid_map.json"):
-            print(f"Index not found for {sample[self.config.r_text_index_key]}/pid_docid_map.json.")
-            return [], []
-        with open(sample[self.config.r_text_index_key]+"/pid_docid_map.json",'r') as f:
+    def load_index(self, index_path):
+        """Load a document's ColBERT index and its passage->page map.
+
+        Every index is searched with the one checkpoint from load_checkpoint; the last few indexes
+        are kept in memory.
+        """
+        if index_path in self.index_cache:
+            self.index_cache.move_to_end(index_path)
+            return self.index_cache[index_path]
+        if not os.path.exists(index_path+"/pid_docid_map.json"):
+            print(f"Index not found for {index_path}/pid_docid_map.json.")
+            return None, None
+        with open(index_path+"/pid_docid_map.json",'r') as f:
             pid_map_data = json.load(f)
-        unique_values = list(dict.fromkeys(pid_map_data.values()))
-        value_to_rank = {val: idx for idx, val in enumerate(unique_values)}
+        value_to_rank = {val: idx for idx, val in enumerate(dict.fromkeys(pid_map_data.values()))}
         pid_map = {int(key): value_to_rank[value] for key, value in pid_map_data.items()}
-        
-        query = sample[self.config.text_question_key]
-        RAG = RAGPretrainedModel.from_index(sample[self.config.r_text_index_key])
-        results = RAG.search(query, k=len(pid_map))
-        
+
+        searcher = IndexSearcher(index_path, self.load_checkpoint())
+        self.index_cache[index_path] = (searcher, pid_map)
+        if len(self.index_cache) > getattr(self.config, "index_cache_size", 2):
+            self.index_cache.popitem(last=False)
+        return searcher, pid_map
+
+    def rank_pages(self, results, pid_map, top_k: int, page_id_list=None):
         top_page_indices = [pid_map[page['passage_id']] for page in results]
         top_page_scores = [page['score'] for page in results]
-        
-        if page_id_key in sample:
-            page_id_list = sample[page_id_key]
+
+        if page_id_list is not None:
             assert isinstance(page_id_list, list)
             filtered_indices = []
             filtered_scores = []
@@ -106,19 +170,230 @@ class ColbertRetrieval(BaseRetrieval):
                     filtered_indices.append(idx)
                     filtered_scores.append(score)
             return filtered_indices[:top_k], filtered_scores[:top_k]
-        
+
         return top_page_indices[:top_k], top_page_scores[:top_k]
-        
+
+    def search_candidates(self, searcher, pid_map, query, page_ids):
+        """Search only the passages of the given pages (PLAID scores just those passages)."""
+        pages = set(page_ids)
+        pids = [pid for pid, page in pid_map.items() if page in pages]
+        if not pids:
+            return []
+        return searcher.rank_passages([query], k=len(pids), pids=pids)[0]
+
+    def find_sample_top_k(self, sample, top_k: int, page_id_key: str):
+        searcher, pid_map = self.load_index(sample[self.config.r_text_index_key])
+        if searcher is None:
+            return [], []
+        query = sample[self.config.text_question_key]
+        page_ids = self.allowed_pages(sample, page_id_key)
+        if self.has_candidates(sample):
+            results = self.search_candidates(searcher, pid_map, query, page_ids)
+        else:
+            results = searcher.rank_passages([query], k=len(pid_map))[0]
+        return self.rank_pages(results, pid_map, top_k, page_ids)
+
     def find_top_k(self, dataset: BaseDataset, force_prepare=False):
         top_k = self.config.top_k
         samples = dataset.load_data(use_retreival=True)
-        
+
         if self.config.r_text_index_key not in samples[0] or force_prepare:
             samples = self.prepare(dataset)
-                
+
+        memo = RetrievalMemo.from_config(
+            self.config, "ColbertRetrieval:" + getattr(self.config, "pretrained_model_path", "colbert-ir/colbertv2.0")
+        )
+        fingerprints = {}
+
+        # Group samples by index so each index is loaded once and all of its queries are searched in one batch
+        index_groups: dict = {}
+        for sample in samples:
+            doc_id = sample[self.config.doc_key]
+            if memo is not None:
+                if doc_id not in fingerprints:
+                    # A rebuilt index has new files, so its rankings are not reused
+                    fingerprints[doc_id] = combine_fingerprints(
+                        dataset.document_fingerprint(sample), path_fingerprint(sample[self.config.r_text_index_key])
+                    )
+                ranking = memo.get(doc_id, sample[self.config.text_question_key], fingerprints[doc_id])
+                if ranking is not None:
+                    sample[self.config.r_text_key], sample[self.config.r_text_key+"_score"] = select_pages(
+                        *ranking, top_k, self.allowed_pages(sample, dataset.config.page_id_key)
+                    )
+                    continue
+            index_groups.setdefault(sample[self.config.r_text_index_key], []).append(sample)
+
+        for index_path, group in tqdm(index_groups.items()):
+            searcher, pid_map = self.load_index(index_path)
+            if searcher is None:
+                for sample in group:
+                    sample[self.config.r_text_key] = []
+                    sample[self.config.r_text_key+"_score"] = []
+                continue
+            # Samples with first-stage candidates are searched one by one over those pages only
+            for sample in group:
+                if self.has_candidates(sample):
+                    page_ids = self.allowed_pages(sample, dataset.config.page_id_key)
+                    results = self.search_candidates(searcher, pid_map, sample[self.config.text_question_key], page_ids)
+                    sample[self.config.r_text_key], sample[self.config.r_text_key+"_score"] = self.rank_pages(
+                        results, pid_map, top_k, page_ids
+                    )
+            group = [sample for sample in group if not self.has_candidates(sample)]
+            if not group:
+                continue
+            queries = [sample[self.config.text_question_key] for sample in group]
+            results = searcher.rank_passages(queries, k=len(pid_map))
+            for sample, sample_results in zip(group, results):
+                if memo is not None:
+                    # search already ranks every passage; memoize that full ranking
+                    doc_id = sample[self.config.doc_key]
+                    all_indices, all_scores = self.rank_pages(sample_results, pid_map, len(sample_results))
+                    memo.put(doc_id, sample[self.config.text_question_key], fingerprints[doc_id], all_indices, all_scores)
+                top_page_indices, top_page_scores = self.rank_pages(
+                    sample_results, pid_map, top_k, sample.get(dataset.config.page_id_key)
+                )
+                sample[self.config.r_text_key] = top_page_indices
+                sample[self.config.r_text_key+"_score"] = top_page_scores
+        if memo is not None:
+            print(f"Retrieval memo: {memo.stats()}")
+        path = dataset.dump_data(samples, use_retreival=True)
+        print(f"Save retrieval results at {path}.")
+
+
+def split_passages(texts, words_per_passage: int):
+    """Cut page texts into passages of at most words_per_passage words; returns passages and their page index."""
+    passages, pages = [], []
+    for page, text in enumerate(texts):
+        words = text.split()
+        for start in range(0, len(words), words_per_passage):
+            passages.append(" ".join(words[start:start+words_per_passage]))
+            pages.append(page)
+    return passages, pages
+
+
+class ColbertFlatRetrieval(ColbertRetrieval):
+    """ColBERT text retrieval over one dataset-level store instead of one index per document.
+
+    Passage token vectors of every document are written to a FlatMultiVectorStore in a single
+    pass; a question is scored with exact MaxSim against its own document's passages, read from
+    the memory-mapped store, and a page scores as its best passage like in the per-document layout.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.query_embeds = {}
+
+    def embed_store_path(self, dataset: BaseDataset):
+        return self.config.embed_dir + "/" + dataset.config.name + "_flat_" + getattr(self.config, "embed_dtype", "float16")
+
+    def prepare(self, dataset: BaseDataset):
+        checkpoint = self.load_checkpoint()
+        store = FlatMultiVectorStore(
+            self.embed_store_path(dataset), dim=checkpoint.colbert_config.dim, dtype=getattr(self.config, "embed_dtype", "float16")
+        )
+        samples = dataset.load_data(use_retreival=True)
         for sample in tqdm(samples):
-            top_page_indices, top_page_scores = self.find_sample_top_k(sample, top_k=top_k, page_id_key = dataset.config.page_id_key)
-            sample[self.config.r_text_key] = top_page_indices
-            sample[self.config.r_text_key+"_score"] = top_page_scores
+            doc_id = sample[self.config.doc_key]
+            if doc_id in store:
+                continue
+            content_list = dataset.load_processed_content(sample)
+            passages, pages = split_passages([content.txt.replace("\n", " ") for content in content_list], self.config.page_chunk_words)
+            embeds = []
+            if passages:
+                with torch.no_grad():
+                    flat_embeds, doclens = checkpoint.docFromText(passages, bsize=self.config.batch_size, keep_dims="flatten", to_cpu=True)
+                embeds = list(torch.split(flat_embeds, list(doclens)))
+            else:
+                print(f"Empty doc {doc_id}.")
+            store.add(doc_id, embeds, pages)
+        store.flush()
+        return store
+
+    def encode_queries(self, queries):
+        """Encode questions in batches; each distinct question text is encoded once per run."""
+        checkpoint = self.load_checkpoint()
+        missing = [query for query in dict.fromkeys(queries) if query not in self.query_embeds]
+        batch_size = getattr(self.config, "query_batch_size", None) or self.config.batch_size
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start+batch_size]
+            with torch.no_grad():
+                batch_query_embed = checkpoint.queryFromText(batch, bsize=batch_size, to_cpu=True)
+            # ColBERT pads queries with [MASK] tokens on purpose, so every position is kept
+            for query, query_embed in zip(batch, batch_query_embed):
+                self.query_embeds[query] = query_embed.float()
+        return [self.query_embeds[query] for query in queries]
+
+    def score_pages(self, query_embeds, passage_embeds, passage_mask, passage_pages):
+        """Best-passage score of every page, shape (n_queries, n_pages); pages without text score -inf."""
+        passage_scores = maxsim_scores(
+            torch.stack(query_embeds), passage_embeds, page_mask=passage_mask,
+            chunk_size=getattr(self.config, "score_chunk_size", 64),
+        ).cpu()
+        index = torch.as_tensor(passage_pages, dtype=torch.long).expand(passage_scores.shape[0], -1)
+        page_scores = torch.full((passage_scores.shape[0], max(passage_pages) + 1), float("-inf"))
+        return page_scores.scatter_reduce(1, index, passage_scores, reduce="amax")
+
+    def rank_samples(self, dataset: BaseDataset, samples, result_key=None):
+        """Write the top_k pages and scores of every sample to result_key (default r_text_key)."""
+        result_key = result_key or self.config.r_text_key
+        top_k = self.config.top_k
+        store_path = self.embed_store_path(dataset)
+        store = FlatMultiVectorStore(store_path) if FlatMultiVectorStore.exists(store_path) else None
+        if store is None or any(sample[self.config.doc_key] not in store for sample in samples):
+            store = self.prepare(dataset)
+        memo = RetrievalMemo.from_config(self.config, ":".join([
+            os.path.basename(store_path), getattr(self.config, "pretrained_model_path", "colbert-ir/colbertv2.0"),
+            f"words{self.config.page_chunk_words}",
+        ]))
+
+        doc_groups: dict = {}
+        fingerprints = {}
+        for sample in samples:
+            doc_id = sample[self.config.doc_key]
+            if memo is not None:
+                if doc_id not in fingerprints:
+                    fingerprints[doc_id] = combine_fingerprints(dataset.document_fingerprint(sample), store.fingerprint(doc_id))
+                ranking = memo.get(doc_id, sample[self.config.text_question_key], fingerprints[doc_id])
+                if ranking is not None:
+                    sample[result_key], sample[result_key+"_score"] = select_pages(
+                        *ranking, top_k, self.allowed_pages(sample, dataset.config.page_id_key)
+                    )
+                    continue
+            doc_groups.setdefault(doc_id, []).append(sample)
+        self.encode_queries([sample[self.config.text_question_key] for group in doc_groups.values() for sample in group])
+
+        for doc_id, group in tqdm(doc_groups.items()):
+            passage_embeds, passage_mask, passage_pages = store.get_doc(doc_id)
+            if passage_embeds is None:
+                for sample in group:
+                    sample[result_key] = []
+                    sample[result_key+"_score"] = []
+                continue
+            page_ids = [self.allowed_pages(sample, dataset.config.page_id_key) for sample in group]
+            # With first-stage candidates only passages of pages some question of the group may return are scored
+            pages = self.candidate_union(group, page_ids)
+            if pages is not None:
+                keep = torch.isin(torch.as_tensor(passage_pages), torch.as_tensor(pages))
+                passage_embeds, passage_mask = passage_embeds[keep], passage_mask[keep]
+                passage_pages = [page for page, kept in zip(passage_pages, keep.tolist()) if kept]
+                if not passage_pages:
+                    for sample in group:
+                        sample[result_key] = []
+                        sample[result_key+"_score"] = []
+                    continue
+            query_embeds = self.encode_queries([sample[self.config.text_question_key] for sample in group])
+            scores = self.score_pages(query_embeds, passage_embeds, passage_mask, passage_pages)
+            n_ranked = int(torch.isfinite(scores[0]).sum())
+            all_indices, all_scores = masked_top_k(scores, n_ranked)
+            for sample, indices, page_scores, ids in zip(group, all_indices, all_scores, page_ids):
+                if memo is not None and pages is None:
+                    memo.put(doc_id, sample[self.config.text_question_key], fingerprints[doc_id], indices, page_scores)
+                sample[result_key], sample[result_key+"_score"] = select_pages(indices, page_scores, top_k, ids)
+        if memo is not None:
+            print(f"Retrieval memo: {memo.stats()}")
+        return samples
+
+    def find_top_k(self, dataset: BaseDataset):
+        samples = dataset.load_data(use_retreival=True)
+        self.rank_samples(dataset, samples)
         path = dataset.dump_data(samples, use_retreival=True)
-        print(f"Save retrieval results at {path}.")
\ No newline at end of file
+        print(f"Save retrieval results at {path}.")
@@ -22,7 +22,8 @@ def main(cfg):
     
     dataset = BaseDataset(cfg.dataset)
     mdoc_agent = MDAs(cfg.mdoc_agent)
-    mdoc_agent.predict_dataset(dataset)
+    mdoc_agent.predict_dataset(dataset, resume_path=cfg.mdoc_agent.resume_path)
+    mdoc_agent.close()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,90 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import time
+import torch
+from tqdm import tqdm
+from mydatasets.base_dataset import BaseDataset
+from retrieval.image_retrieval import ColpaliRetrieval
+from retrieval.embed_store import EmbeddingStore, pool_tokens
+from retrieval.maxsim import maxsim_scores, masked_top_k
+from retrieval.metrics import evidence_pages
+import hydra
+
+# Compares compressed ColPali page embeddings against the full-precision store:
+# index size, total scoring latency, recall@k of the uncompressed top-k and,
+# when samples carry 1-based `evidence_pages`, recall@k of the evidence pages.
+# Usage: python scripts/bench_embed_compression.py --config-name <dataset> retrieval=image
+VARIANTS = [
+    ("float32", 1),
+    ("float16", 1),
+    ("int8", 1),
+    ("float16", 2),
+    ("int8", 2),
+    ("int8", 4),
+]
+
+def run(retrieval, store, groups, page_id_key, top_k):
+    results = {}
+    elapsed = 0.0
+    for doc_id, group in tqdm(groups.items()):
+        document_embed = store[doc_id]
+        if document_embed is None:
+            continue
+        query_embeds = retrieval.encode_queries([sample[retrieval.config.image_question_key] for sample in group])
+        start = time.perf_counter()
+        scores = maxsim_scores(query_embeds, document_embed, chunk_size=retrieval.config.score_chunk_size)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+        indices, _ = masked_top_k(scores, top_k, [sample.get(page_id_key) for sample in group])
+        for sample, sample_indices in zip(group, indices):
+            results[id(sample)] = sample_indices
+    return results, elapsed
+
+@hydra.main(config_path="../config", config_name="base", version_base="1.2")
+def main(cfg):
+    os.environ["CUDA_VISIBLE_DEVICES"] = cfg.retrieval.cuda_visible_devices
+    cfg.retrieval.embed_dtype = "float32"
+    cfg.retrieval.embed_pool_factor = 1
+    dataset = BaseDataset(cfg.dataset)
+    retrieval = ColpaliRetrieval(cfg.retrieval)
+    baseline = retrieval.load_document_embeds(dataset)
+    top_k = cfg.retrieval.top_k
+
+    samples = dataset.load_data(use_retreival=True)
+    if cfg.dataset.truncate_len:
+        samples = samples[:cfg.dataset.truncate_len]
+    groups = {}
+    for sample in samples:
+        groups.setdefault(sample[cfg.retrieval.doc_key], []).append(sample)
+
+    reference, _ = run(retrieval, baseline, groups, cfg.dataset.page_id_key, top_k)
+    bench_dir = os.path.join(cfg.retrieval.embed_dir, "bench", dataset.config.name)
+    print(f"{'variant':<16}{'size (MB)':>12}{'score (s)':>12}{'recall@k':>12}{'evidence@k':>12}")
+    for dtype, pool_factor in VARIANTS:
+        name = f"{dtype}-pool{pool_factor}"
+        store = EmbeddingStore(os.path.join(bench_dir, name), dtype=dtype)
+        for doc_id in tqdm(groups, desc=name):
+            if doc_id not in store:
+                embeds = baseline[doc_id]
+                store.put(doc_id, None if embeds is None else pool_tokens(embeds, pool_factor))
+
+        results, elapsed = run(retrieval, store, groups, cfg.dataset.page_id_key, top_k)
+        overlap, evidence_hits, evidence_total = [], 0, 0
+        for sample in samples:
+            if id(sample) not in results:
+                continue
+            ref, got = set(reference[id(sample)]), set(results[id(sample)])
+            if ref:
+                overlap.append(len(ref & got) / len(ref))
+            evidence = evidence_pages(sample)
+            if evidence:
+                evidence_hits += len(evidence & got)
+                evidence_total += len(evidence)
+        recall = sum(overlap) / len(overlap) if overlap else float("nan")
+        evidence_recall = evidence_hits / evidence_total if evidence_total else float("nan")
+        print(f"{name:<16}{store.nbytes() / 2**20:>12.1f}{elapsed:>12.2f}{recall:>12.3f}{evidence_recall:>12.3f}")
+
+if __name__ == "__main__":
+    main()
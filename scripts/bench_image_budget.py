@@ -0,0 +1,63 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mydatasets.base_dataset import BaseDataset
+from agents.base_agent import Agent
+from models.image_budget import ImageBudget
+from models.memory import image_pixels
+import time
+import hydra
+
+# Latency / visual tokens / accuracy of the image agent under different visual-token budgets.
+# Usage: python scripts/bench_image_budget.py --config-name <dataset> dataset.top_k=4 +samples=50 \
+#            "+budgets=[null,4096,2048,1024]" +eval=true
+@hydra.main(config_path="../config", config_name="base", version_base="1.2")
+def main(cfg):
+    os.environ["CUDA_VISIBLE_DEVICES"] = cfg.mdoc_agent.cuda_visible_devices
+    agent_config = cfg.mdoc_agent.agents[0]
+    agent_config.agent = hydra.compose(config_name="agent/"+agent_config.agent, overrides=[]).agent
+    agent_config.model = hydra.compose(config_name="model/"+agent_config.model, overrides=[]).model
+    agent = Agent(agent_config)
+
+    evaluator = None
+    if cfg.get("eval", False):
+        cfg.eval_agent.agent = hydra.compose(config_name="agent/"+cfg.eval_agent.agent, overrides=[]).agent
+        cfg.eval_agent.model = hydra.compose(config_name="model/"+cfg.eval_agent.model, overrides=[]).model
+        evaluator = Agent(cfg.eval_agent)
+
+    dataset = BaseDataset(cfg.dataset)
+    samples = dataset.load_data(use_retreival=True)[:cfg.get("samples", 50)]
+    inputs = [dataset.load_sample_retrieval_data(sample) for sample in samples]
+    model_cfg = agent_config.model
+    rows = []
+    for budget in cfg.get("budgets", [None, 4096, 2048, 1024]):
+        agent.image_budget = ImageBudget(
+            min_pixels=getattr(model_cfg, "min_pixels", None),
+            max_pixels=getattr(model_cfg, "max_pixels", None),
+            visual_token_budget=budget,
+            top_page_share=getattr(model_cfg, "top_page_share", 0.5),
+        )
+        agent.model_kwargs = {"image_budget": agent.image_budget}
+        seconds, visual_tokens, correct = 0.0, 0, 0
+        for sample, (question, _, images) in zip(samples, inputs):
+            for image, max_pixels in zip(images, agent.image_budget.allocate(len(images))):
+                pixels = image_pixels(image)
+                visual_tokens += (min(pixels, max_pixels) if max_pixels else pixels) // (28 * 28)
+            start = time.time()
+            answer, _ = agent.predict(question, images=images)
+            seconds += time.time() - start
+            agent.clean_messages()
+            if evaluator is not None:
+                result = evaluator.eval(question, answer, sample[dataset.config.gt_key])
+                correct += result.get("binary_correctness", 0)
+        n = max(len(samples), 1)
+        rows.append((budget, seconds / n, visual_tokens / n, correct / n if evaluator is not None else None))
+        print(f"budget={budget}: {seconds / n:.2f}s/sample, {visual_tokens / n:.0f} visual tokens/sample")
+
+    print(f"{'budget':>8} {'s/sample':>9} {'vis tok':>8} {'accuracy':>9}")
+    for budget, latency, tokens, accuracy in rows:
+        accuracy = "-" if accuracy is None else f"{accuracy:.3f}"
+        print(f"{str(budget):>8} {latency:>9.2f} {tokens:>8.0f} {accuracy:>9}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import time
+from mydatasets.base_dataset import BaseDataset
+from retrieval.text_retrieval import ColbertFlatRetrieval
+from retrieval.metrics import evidence_pages
+import hydra
+
+# Compares the dataset-level flat ColBERT store against the per-document indexes:
+# build and query time, store size, recall@k of the per-document top-k (read from
+# the retrieval results of `retrieval=text`, run it first) and, when samples carry
+# 1-based `evidence_pages`, recall@k of the evidence pages for both layouts.
+# Usage: python scripts/bench_text_backends.py --config-name <dataset> retrieval=text_flat
+FLAT_KEY = "flat-bench"
+
+def store_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+@hydra.main(config_path="../config", config_name="base", version_base="1.2")
+def main(cfg):
+    os.environ["CUDA_VISIBLE_DEVICES"] = cfg.retrieval.cuda_visible_devices
+    cfg.retrieval.memo_path = None
+    dataset = BaseDataset(cfg.dataset)
+    retrieval = ColbertFlatRetrieval(cfg.retrieval)
+    reference_key = cfg.retrieval.r_text_key
+
+    samples = dataset.load_data(use_retreival=True)
+    if cfg.dataset.truncate_len:
+        samples = samples[:cfg.dataset.truncate_len]
+    missing = sum(reference_key not in sample for sample in samples)
+    if missing:
+        print(f"[WARNING] {missing} samples lack per-document results under {reference_key}; run retrieval=text first.")
+
+    start = time.perf_counter()
+    retrieval.prepare(dataset)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    retrieval.rank_samples(dataset, samples, result_key=FLAT_KEY)
+    query_time = time.perf_counter() - start
+
+    overlap = []
+    evidence_hits = {reference_key: 0, FLAT_KEY: 0}
+    evidence_total = 0
+    for sample in samples:
+        ref, got = set(sample.get(reference_key, [])), set(sample[FLAT_KEY])
+        if ref:
+            overlap.append(len(ref & got) / len(ref))
+        evidence = evidence_pages(sample)
+        if evidence:
+            evidence_total += len(evidence)
+            for key in evidence_hits:
+                evidence_hits[key] += len(evidence & set(sample.get(key, [])))
+    recall = sum(overlap) / len(overlap) if overlap else float("nan")
+    print(f"Dataset: {dataset.config.name}, samples: {len(samples)}, top_k: {cfg.retrieval.top_k}")
+    print(f"Flat store: {store_size(retrieval.embed_store_path(dataset)) / 2**20:.1f} MB, build {build_time:.1f}s, query {query_time:.1f}s")
+    print(f"Recall@k of per-document top-k: {recall:.3f} ({len(overlap)} samples)")
+    if evidence_total:
+        for key, hits in evidence_hits.items():
+            print(f"Evidence recall@k {key}: {hits / evidence_total:.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mydatasets.base_dataset import BaseDataset
+import hydra
+
+@hydra.main(config_path="../config", config_name="base", version_base="1.2")
+def main(cfg):
+    # Results of an interrupted run, merged from its log into a JSON file that eval.py picks up
+    dataset = BaseDataset(cfg.dataset)
+    path = dataset.compact_results(cfg.mdoc_agent.resume_path)
+    print(f"Save results to {path}.")
+
+if __name__ == "__main__":
+    main()
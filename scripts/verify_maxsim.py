@@ -0,0 +1,39 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import torch
+from colpali_engine.trainer.retrieval_evaluator import CustomEvaluator
+from retrieval.maxsim import maxsim_scores, masked_top_k
+
+# Checks retrieval.maxsim against colpali_engine's CustomEvaluator on random ColPali-shaped embeddings.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--page-len", type=int, default=1030)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    queries = [torch.nn.functional.normalize(torch.randn(torch.randint(8, 24, ()).item(), args.dim), dim=-1).to(device)
+               for _ in range(args.queries)]
+    pages = torch.nn.functional.normalize(torch.randn(args.pages, args.page_len, args.dim), dim=-1).to(device)
+
+    expected = torch.as_tensor(CustomEvaluator(is_multi_vector=True).evaluate(queries, pages)).float().cpu()
+    scores = maxsim_scores(queries, pages, chunk_size=args.chunk_size).cpu()
+    print(f"max abs diff: {(scores - expected).abs().max().item():.3e}")
+    assert torch.allclose(scores, expected, atol=1e-3), "MaxSim scores differ from CustomEvaluator"
+
+    page_ids = [list(range(0, args.pages, 3)) if i % 2 else None for i in range(args.queries)]
+    indices, _ = masked_top_k(scores, 5, page_ids)
+    for row, ids in enumerate(page_ids):
+        allowed = ids if ids else list(range(args.pages))
+        expected_top = sorted(allowed, key=lambda page: -scores[row, page].item())[:5]
+        assert indices[row] == expected_top, f"top-k mismatch for query {row}"
+    print("OK")
+
+if __name__ == "__main__":
+    main()
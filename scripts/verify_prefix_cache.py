@@ -0,0 +1,56 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mydatasets.base_dataset import BaseDataset
+import importlib
+import time
+import hydra
+
+# Checks that generation with the prefix KV cache (pinned system prompt + reused first turn)
+# gives the same greedy outputs as uncached generation, for the general agent's model.
+# Usage: python scripts/verify_prefix_cache.py +samples=5
+@hydra.main(config_path="../config", config_name="base", version_base="1.2")
+def main(cfg):
+    os.environ["CUDA_VISIBLE_DEVICES"] = cfg.mdoc_agent.cuda_visible_devices
+    agent_config = cfg.mdoc_agent.agents[-1]
+    agent_cfg = hydra.compose(config_name="agent/"+agent_config.agent, overrides=[]).agent
+    model_cfg = hydra.compose(config_name="model/"+agent_config.model, overrides=[]).model
+
+    module = importlib.import_module(model_cfg.module_name)
+    model = getattr(module, model_cfg.class_name)(model_cfg)
+    hf_model = model.pipeline.model if hasattr(model, "pipeline") else model.model
+    hf_model.generation_config.do_sample = False
+    cache = model.prefix_cache
+
+    dataset = BaseDataset(cfg.dataset)
+    samples = dataset.load_data(use_retreival=True)[:cfg.get("samples", 5)]
+    system_message = model.create_system_message(agent_cfg.system_prompt)
+    timings = {"uncached": 0.0, "cached": 0.0}
+    mismatches = 0
+    for sample in samples:
+        question, texts, images = dataset.load_sample_retrieval_data(sample)
+        texts = texts if agent_cfg.use_text else None
+        images = images if agent_cfg.use_image else None
+        outputs = {}
+        for mode in ("uncached", "cached"):
+            model.prefix_cache = cache if mode == "cached" else None
+            if mode == "cached":
+                model.cache_prefix([system_message])
+                cache = model.prefix_cache
+            start = time.time()
+            answer, messages = model.predict(question, texts, images, [system_message])
+            reflection, _ = model.predict(agent_cfg.critical_prompt, history=messages)
+            timings[mode] += time.time() - start
+            outputs[mode] = (answer, reflection)
+        if outputs["uncached"] != outputs["cached"]:
+            mismatches += 1
+            print(f"Mismatch for question: {question}\n  uncached: {outputs['uncached']}\n  cached:   {outputs['cached']}")
+
+    print(f"Samples: {len(samples)}, mismatches: {mismatches}")
+    print(f"Uncached: {timings['uncached']:.1f}s, cached: {timings['cached']:.1f}s")
+    print(f"Cache hits: {cache.hits}, misses: {cache.misses}, reused tokens: {cache.reused_tokens}")
+    assert mismatches == 0, "Cached generation differs from uncached greedy decoding"
+    print("OK")
+
+if __name__ == "__main__":
+    main()
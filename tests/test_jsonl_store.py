@@ -0,0 +1,29 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mydatasets.jsonl_store import JsonlWriter, iter_jsonl
+
+
+def test_resume_from_truncated_log(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    with JsonlWriter(path) as writer:
+        writer.write({"_index": 0, "ans": "A0"})
+    # A crash mid-write leaves a partial last line
+    with open(path, "a") as f:
+        f.write('{"_index": 1, "an')
+
+    with JsonlWriter(path) as writer:
+        writer.write({"_index": 1, "ans": "A1"})
+
+    assert list(iter_jsonl(path)) == [{"_index": 0, "ans": "A0"}, {"_index": 1, "ans": "A1"}]
+
+
+def test_resume_from_log_without_complete_line(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    with open(path, "w") as f:
+        f.write('{"_index": 0')
+
+    with JsonlWriter(path) as writer:
+        writer.write({"_index": 0, "ans": "A0"})
+
+    assert list(iter_jsonl(path)) == [{"_index": 0, "ans": "A0"}]
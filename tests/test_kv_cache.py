@@ -0,0 +1,103 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+from models.kv_cache import PrefixKVCache
+
+IMAGE_PAD = 0
+
+
+class ToyCache():
+    """Per-position hidden states, with the crop/get_seq_length interface of a transformers Cache."""
+    def __init__(self):
+        self.states = []
+
+    def get_seq_length(self):
+        return len(self.states)
+
+    def crop(self, length):
+        del self.states[length:]
+
+
+class ToyModel():
+    """Tiny causal LM: each position's state depends on every earlier token, so a cache
+    that covers the wrong prefix changes the greedy output."""
+    def __init__(self, vocab=64, dim=16):
+        generator = torch.Generator().manual_seed(0)
+        self.embed = torch.randn(vocab, dim, generator=generator, dtype=torch.float64)
+        self.mix = torch.randn(dim, dim, generator=generator, dtype=torch.float64) / dim ** 0.5
+        self.out = torch.randn(dim, vocab, generator=generator, dtype=torch.float64)
+
+    def step(self, cache, token, image=None):
+        previous = cache.states[-1] if cache.states else torch.zeros(self.mix.shape[0], dtype=torch.float64)
+        # Image pad tokens carry the image content, like merged vision embeddings
+        embedding = self.embed[token] if image is None else self.embed[token] * image
+        cache.states.append(torch.tanh(previous @ self.mix + embedding))
+
+    def generate(self, input_ids, images=(), past_key_values=None, max_new_tokens=8):
+        cache = past_key_values if past_key_values is not None else ToyCache()
+        ids = input_ids.tolist()
+        image_at = {position: value for value, start, end in images for position in range(start, end)}
+        for position in range(cache.get_seq_length(), len(ids)):
+            self.step(cache, ids[position], image_at.get(position))
+        for index in range(max_new_tokens):
+            token = int((cache.states[-1] @ self.out).argmax())
+            ids.append(token)
+            # Like generate(), the last sampled token has no cache entry yet
+            if index < max_new_tokens - 1:
+                self.step(cache, token)
+        return torch.tensor(ids), cache
+
+
+def generate_with_cache(model, prefix_cache, input_ids, images=()):
+    refs = [(f"image-{value}", start, end) for value, start, end in images]
+    past_key_values, _, _ = prefix_cache.lookup(input_ids, images=refs)
+    sequences, cache = model.generate(input_ids, images, past_key_values)
+    prefix_cache.store(sequences, cache, extra={"images": refs})
+    return sequences[len(input_ids):]
+
+
+def generate_uncached(model, input_ids, images=()):
+    sequences, _ = model.generate(input_ids, images)
+    return sequences[len(input_ids):]
+
+
+def random_tokens(n, seed):
+    return torch.randint(1, 64, (n,), generator=torch.Generator().manual_seed(seed))
+
+
+def test_follow_up_turn_hit_matches_miss():
+    model, prefix_cache = ToyModel(), PrefixKVCache(max_entries=2)
+    first_turn = random_tokens(100, seed=1)
+    answer = generate_with_cache(model, prefix_cache, first_turn)
+    follow_up = torch.cat([first_turn, answer, random_tokens(20, seed=2)])
+
+    assert torch.equal(generate_with_cache(model, prefix_cache, follow_up), generate_uncached(model, follow_up))
+    assert prefix_cache.hits == 1
+    assert prefix_cache.reused_tokens == len(first_turn) + len(answer) - 1
+
+
+def test_pinned_prefix_hit_matches_miss():
+    model, prefix_cache = ToyModel(), PrefixKVCache(max_entries=0)
+    system = random_tokens(70, seed=3)
+    _, cache = model.generate(system, max_new_tokens=1)
+    prefix_cache.store(system, cache, pinned=True)
+
+    for seed in (4, 5):
+        prompt = torch.cat([system, random_tokens(30, seed=seed)])
+        assert torch.equal(generate_with_cache(model, prefix_cache, prompt), generate_uncached(model, prompt))
+    # The pinned entry is copied, not cropped, so both questions reused all of it
+    assert prefix_cache.hits == 2
+    assert prefix_cache.reused_tokens == 2 * len(system)
+
+
+def test_changed_image_is_recomputed():
+    model, prefix_cache = ToyModel(), PrefixKVCache(max_entries=2, min_copy_prefix=1)
+    prompt = random_tokens(100, seed=6)
+    prompt[40:60] = IMAGE_PAD
+    generate_with_cache(model, prefix_cache, prompt, images=[(0.5, 40, 60)])
+
+    # Same token ids, different page: only the tokens before the image can be reused
+    answer = generate_with_cache(model, prefix_cache, prompt, images=[(2.0, 40, 60)])
+    assert torch.equal(answer, generate_uncached(model, prompt, images=[(2.0, 40, 60)]))
+    assert prefix_cache.reused_tokens == 40
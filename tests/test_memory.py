@@ -0,0 +1,32 @@
+import os
+import sys
+import threading
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models.memory import MemoryBudget
+
+
+def test_concurrent_calls_are_not_fitted():
+    budgets = [MemoryBudget(), MemoryBudget()]
+    both_running = threading.Barrier(2)
+
+    def generate(budget):
+        with budget.track(tokens=100):
+            both_running.wait(timeout=10)
+
+    threads = [threading.Thread(target=generate, args=(budget,)) for budget in budgets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Each call's peak also covers the other model's call, so neither is a sample for the fit
+    for budget in budgets:
+        assert budget.calls == 1
+        assert budget.overlapped == 1
+        assert len(budget.history) == 0
+
+    # A call running alone is measured again
+    with budgets[0].track(tokens=100):
+        pass
+    assert len(budgets[0].history) == 1
+    assert budgets[0].overlapped == 1
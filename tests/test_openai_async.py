@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+from omegaconf import OmegaConf
+from openai import RateLimitError
+from PIL import Image
+from models.openai import AsyncMyOpenAI, TokenBudget
+
+
+class StubServer():
+    """OpenAI-compatible chat completions endpoint that records how many requests overlap."""
+    def __init__(self, rate_limited=0, delay=0.05):
+        self.rate_limited = rate_limited
+        self.delay = delay
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                with server.lock:
+                    server.requests += 1
+                    limited = server.requests <= server.rate_limited
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                time.sleep(server.delay)
+                with server.lock:
+                    server.in_flight -= 1
+                if limited:
+                    self.reply(429, {"error": {"message": "rate limited"}}, {"retry-after": "0"})
+                    return
+                self.reply(200, {
+                    "id": "stub", "object": "chat.completion", "created": 0, "model": "stub",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 7, "completion_tokens": 3, "total_tokens": 10},
+                })
+
+            def reply(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_model(url, **config):
+    return AsyncMyOpenAI(OmegaConf.create({
+        "model": "stub", "api_key": "test", "base_url": url, "max_new_tokens": 16, "temperature": 0,
+        "backoff_base": 0.01, "backoff_max": 0.05, **config,
+    }))
+
+
+async def predict_all(model, questions):
+    results = await asyncio.gather(*[model.apredict(question) for question in questions])
+    await model.aclose()
+    return results
+
+
+@pytest.fixture
+def server():
+    servers = []
+    def start(**kwargs):
+        servers.append(StubServer(**kwargs))
+        return servers[-1]
+    yield start
+    for stub in servers:
+        stub.close()
+
+
+def test_requests_in_flight_are_limited(server):
+    stub = server()
+    model = make_model(stub.url, max_concurrency=2)
+    results = asyncio.run(predict_all(model, [f"q{i}" for i in range(8)]))
+    assert [answer for answer, _ in results] == ["ok"] * 8
+    assert stub.max_in_flight == 2
+
+
+def test_rate_limited_requests_are_retried(server):
+    stub = server(rate_limited=2)
+    model = make_model(stub.url, max_concurrency=1, max_retries=3)
+    (answer, _), = asyncio.run(predict_all(model, ["q"]))
+    assert answer == "ok"
+    assert stub.requests == 3
+
+
+def test_retries_give_up(server):
+    stub = server(rate_limited=10)
+    model = make_model(stub.url, max_concurrency=1, max_retries=1)
+    with pytest.raises(RateLimitError):
+        asyncio.run(predict_all(model, ["q"]))
+    assert stub.requests == 2
+
+
+def test_token_budget_settles_to_reported_usage(server):
+    stub = server()
+    model = make_model(stub.url, tokens_per_minute=100000)
+    asyncio.run(predict_all(model, ["q0", "q1", "q2"]))
+    # Estimates are replaced by the usage the server reported
+    assert model.token_budget.used == 3 * 10
+
+
+def test_token_budget_waits_for_the_window(monkeypatch):
+    clock = [0.0]
+    real_sleep = asyncio.sleep
+    async def fake_sleep(seconds):
+        clock[0] += seconds
+        await real_sleep(0)
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+
+    async def run():
+        budget = TokenBudget(100)
+        await budget.acquire(60)
+        await budget.acquire(60)
+        return budget
+    budget = asyncio.run(run())
+    # The second request only fits once the first left the one-minute window
+    assert clock[0] == 60
+    assert budget.used == 60
+
+
+def test_image_estimate_ignores_base64_size(tmp_path):
+    path = str(tmp_path / "page.png")
+    Image.effect_noise((1024, 1024), 64).convert("RGB").save(path)
+    model = make_model(None)
+    messages = [model.create_image_message([path], "question")]
+    payload = len(messages[0]["content"][0]["image_url"]["url"])
+    estimated = model.estimate_tokens(messages, 0)
+    # 1024x1024 is resized to 768x768: 4 tiles
+    assert estimated == 85 + 4 * 170 + 4 + len("question") // 4
+    assert estimated < payload // 40